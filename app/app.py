@@ -1,24 +1,61 @@
 import os
+import re
+import uuid
 import socket
 import sqlite3
+import queue
 import subprocess
 import json
 import threading
 import time
+import heapq
 import shutil
-import urllib.request
 import urllib.parse
-from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify
+import http.client
+import base64
+import hashlib
+import secrets
+import bisect
+from collections import deque, OrderedDict
+from contextlib import contextmanager, nullcontext
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, render_template, request, redirect, url_for, session, flash, jsonify, Response, stream_with_context
 from werkzeug.security import generate_password_hash, check_password_hash
-from datetime import datetime
+from datetime import datetime, timedelta
 from zoneinfo import ZoneInfo
+try: import docker
+except ImportError: docker = None
 
 app = Flask(__name__)
 
 # --- CONFIGURACION ---
 app.secret_key = 'shieldpi_clave_maestra_fija_v2.8_inplace'
-DB_PATH = '/app/config/shieldpi.db'
-KOPIA_CONFIG = '/app/config/repository.config'
+# CONFIG_DIR y HOST_ROOT solo cambian fuera del contenedor (bench/, pruebas locales)
+CONFIG_DIR = os.environ.get('SHIELDPI_CONFIG_DIR', '/app/config')
+HOST_ROOT = os.path.normpath(os.environ.get('SHIELDPI_HOST_ROOT', '/host'))
+DB_PATH = os.path.join(CONFIG_DIR, 'shieldpi.db')
+KOPIA_CONFIG = os.path.join(CONFIG_DIR, 'repository.config')
+HISTORY_PAGE_SIZE = 50
+JOB_WORKERS = int(os.environ.get('SHIELDPI_JOB_WORKERS', '2'))
+JOB_LOG_LINES = 500
+BROWSE_PAGE_SIZE = 200
+STREAM_CHUNK = 256 * 1024
+DIR_SIZE_TTL = 600
+DIR_SIZE_ENTRIES = 512
+# Sistemas de archivos cuyo tamano no se calcula: virtuales del kernel, de docker o de red (con / montado en /host)
+NO_SIZE_FS = {'proc', 'sysfs', 'devtmpfs', 'devpts', 'tmpfs', 'cgroup', 'cgroup2', 'debugfs', 'tracefs', 'securityfs', 'pstore', 'bpf',
+              'mqueue', 'hugetlbfs', 'configfs', 'fusectl', 'autofs', 'nsfs', 'binfmt_misc', 'rpc_pipefs', 'efivarfs', 'overlay',
+              'nfs', 'nfs4', 'cifs', 'smb3', 'fuse.sshfs', 'fuse.rclone', '9p'}
+KOPIA_BACKEND = os.environ.get('SHIELDPI_KOPIA_BACKEND', 'cli')
+KOPIA_SERVER_ADDRESS = os.environ.get('SHIELDPI_KOPIA_SERVER_ADDRESS', '127.0.0.1:51516')
+# Credenciales del servidor: fijas si es externo (SHIELDPI_KOPIA_SERVER_EXTERNAL), aleatorias si lo arranca ShieldPi
+KOPIA_SERVER_USER = os.environ.get('SHIELDPI_KOPIA_SERVER_USER', 'shieldpi')
+KOPIA_SERVER_PASSWORD = os.environ.get('SHIELDPI_KOPIA_SERVER_PASSWORD')
+TELEGRAM_API = os.environ.get('SHIELDPI_TELEGRAM_API', 'https://api.telegram.org')
+NOTIFY_TIMEOUT = 10
+NOTIFY_RETRIES = int(os.environ.get('SHIELDPI_NOTIFY_RETRIES', '4'))
+NOTIFY_COALESCE = float(os.environ.get('SHIELDPI_NOTIFY_COALESCE', '5'))
+METRICS_TOKEN = os.environ.get('SHIELDPI_METRICS_TOKEN', '')
 
 # --- GESTION DE ZONA HORARIA DINAMICA ---
 try:
@@ -29,223 +66,1753 @@ except Exception as e:
     print(f"Error cargando TZ, usando UTC: {e}", flush=True)
     LOCAL_TZ = ZoneInfo("UTC")
 
+# --- METRICAS ---
+# Histogramas y contadores en memoria con etiquetas; /metrics los publica en formato Prometheus junto con
+# gauges calculados de la base de datos al momento (duracion y tamano por origen, sync, antiguedad del backup).
+METRIC_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600, 14400)
+_metrics_lock = threading.Lock()
+_histograms = {}
+_counters = {}
+
+def observe(name, value, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock:
+        h = _histograms.get(key)
+        if h is None: h = _histograms[key] = {'buckets': [0] * len(METRIC_BUCKETS), 'sum': 0.0, 'count': 0, 'max': 0.0}
+        i = bisect.bisect_left(METRIC_BUCKETS, value)
+        if i < len(METRIC_BUCKETS): h['buckets'][i] += 1
+        h['sum'] += value; h['count'] += 1; h['max'] = max(h['max'], value)
+
+def inc(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with _metrics_lock: _counters[key] = _counters.get(key, 0) + value
+
+# Palabras de subcomando de kopia que pueden ir en una etiqueta: el resto (IDs de objeto o snapshot, buckets) se
+# descarta para que cada llamada no cree una serie nueva
+KOPIA_VERBS = {'repository', 'policy', 'snapshot', 'maintenance', 'content', 'blob', 'server', 'show', 'ls', 'status', 'connect',
+               'create', 'disconnect', 'sync-to', 'list', 'set', 'get', 'delete', 'restore', 'expire', 'gc', 'run', 'info', 'stats',
+               'start', 's3', 'filesystem'}
+
+def command_label(cmd):
+    # 'kopia snapshot create' -> ('kopia', 'snapshot create'); 'docker stop x' -> ('docker', 'stop'). Sin rutas ni nombres.
+    tool = os.path.basename(cmd[0]) if cmd else ''
+    words = [a for a in cmd[1:] if not a.startswith('-') and '/' not in a]
+    if tool == 'kopia': return tool, ' '.join([w for w in words if w in KOPIA_VERBS][:2])
+    return tool, ' '.join(words[:1])
+
 # --- HELPERS ---
-def run_command(cmd, env=None):
+def run_command(cmd, env=None, job=None):
     final_env = os.environ.copy()
     if env: final_env.update(env)
+    started = time.time(); code, out, err = -1, "", ""
     try:
-        result = subprocess.run(cmd, env=final_env, capture_output=True, text=True)
-        return result.returncode == 0, result.stdout, result.stderr
-    except Exception as e:
-        return False, "", str(e)
+        if job: code, out, err = _run_streaming(cmd, final_env, job)
+        else:
+            result = subprocess.run(cmd, env=final_env, capture_output=True, text=True)
+            code, out, err = result.returncode, result.stdout, result.stderr
+    except Exception as e: err = str(e)
+    record_command(cmd, started, code, len(out) + len(err))
+    return code == 0 and not (job and job.cancelled), out, err
+
+def record_command(cmd, started, code, nbytes):
+    # Todas las llamadas a kopia y docker pasan por aqui: latencia, codigo de salida y volumen de salida
+    tool, command = command_label(cmd)
+    observe('shieldpi_command_duration_seconds', time.time() - started, tool=tool, command=command)
+    inc('shieldpi_command_total', tool=tool, command=command, code=str(code))
+    inc('shieldpi_command_output_bytes_total', nbytes, tool=tool, command=command)
+
+def stream_kopia(args):
+    # Salida de kopia por trozos directo al cliente, sin pasar por disco. Devuelve None si kopia falla antes de
+    # escribir nada; si el cliente corta la descarga, el generador se cierra y el proceso se mata.
+    cmd = ['kopia', '--config-file', KOPIA_CONFIG] + args; started = time.time()
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    first = proc.stdout.read(STREAM_CHUNK)
+    if not first and proc.wait() != 0:
+        record_command(cmd, started, proc.returncode, 0); return None
+    def chunks():
+        sent = len(first)
+        try:
+            yield first
+            for chunk in iter(lambda: proc.stdout.read(STREAM_CHUNK), b''): sent += len(chunk); yield chunk
+            proc.wait()
+        finally:
+            if proc.poll() is None: proc.kill(); proc.wait()
+            record_command(cmd, started, proc.returncode, sent)
+    return chunks()
 
-def run_kopia(args, env=None):
+def _run_streaming(cmd, env, job):
+    # kopia escribe el progreso en stderr separado por \r: se reenvia linea a linea al trabajo.
+    # stdout se drena en otro hilo para que el proceso no se bloquee con el pipe lleno.
+    proc = subprocess.Popen(cmd, env=env, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    job.attach(proc)
+    out = []; t = threading.Thread(target=lambda: out.append(proc.stdout.read()), daemon=True); t.start()
+    err_lines = deque(maxlen=20); buf = b''; fd = proc.stderr.fileno()
+    try:
+        while True:
+            chunk = os.read(fd, 4096)
+            if chunk: buf += chunk
+            parts = re.split(rb'[\r\n]', buf) if chunk else [buf, b'']
+            buf = parts.pop()
+            for part in parts:
+                line = part.decode(errors='replace').strip()
+                if line: err_lines.append(line); job.log(line)
+            if not chunk: break
+        proc.wait(); t.join()
+    finally: job.detach(proc)
+    return proc.returncode, (out[0] if out else b'').decode(errors='replace'), '\n'.join(err_lines)
+
+def run_kopia(args, env=None, job=None):
     cmd = ['kopia', '--config-file', KOPIA_CONFIG] + args
-    return run_command(cmd, env)
+    return run_command(cmd, env, job)
+
+# --- BACKEND KOPIA (CLI o servidor persistente) ---
+# KopiaCLI lanza un proceso por operacion. KopiaServer mantiene un 'kopia server' local con el repositorio ya abierto
+# y habla con su API por una conexion keep-alive por hilo; ante cualquier fallo vuelve al camino CLI.
+class KopiaCLI:
+    def repo_status(self):
+        success, out, _ = run_kopia(['repository', 'status', '--json'])
+        if success:
+            try:
+                data = json.loads(out)
+                return True, data.get('storage', {}).get('config', {}).get('path', 'Desconocido')
+            except: return True, "Conectado"
+        return False, None
+
+    def policy_list(self):
+        success, out, _ = run_kopia(['policy', 'list', '--json'])
+        if not success: return None
+        try: return json.loads(out) or []
+        except: return None
+
+    def snapshot_list(self, paths=None):
+        success, out, _ = run_kopia(['snapshot', 'list'] + list(paths or []) + ['--json'])
+        if not success: return None
+        try: return json.loads(out) or []
+        except: return None
+
+    def show_directory(self, oid):
+        success, out, _ = run_kopia(['show', oid])
+        if not success: return None
+        try: return json.loads(out).get('entries') or []
+        except: return None
+
+    def restore(self, sid, path, job=None):
+        s, _, e = run_kopia(['snapshot', 'restore', sid, path], job=job)
+        return s, e
+
+    def refresh(self): pass
+    def reset(self): pass
+
+class KopiaServer(KopiaCLI):
+    def __init__(self, address=KOPIA_SERVER_ADDRESS, external=False):
+        self.address = address; self.external = external
+        self.user = KOPIA_SERVER_USER; self.password = KOPIA_SERVER_PASSWORD or secrets.token_urlsafe(24)
+        self.proc = None; self.repo_path = None
+        self._lock = threading.Lock(); self._local = threading.local()
+
+    def _ensure_server(self):
+        if self.external: return
+        with self._lock:
+            if self.proc and self.proc.poll() is None: return
+            print(f"--- Iniciando kopia server en {self.address} ---", flush=True)
+            self.proc = subprocess.Popen(['kopia', '--config-file', KOPIA_CONFIG, 'server', 'start', f'--address={self.address}', '--insecure',
+                                          f'--server-username={self.user}', f'--server-password={self.password}', '--disable-csrf-token-checks'],
+                                         stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            for _ in range(100):
+                if self.proc.poll() is not None: raise RuntimeError('kopia server termino al iniciar')
+                try: socket.create_connection(self.address.rsplit(':', 1), timeout=0.2).close(); return
+                except OSError: time.sleep(0.1)
+            raise RuntimeError('kopia server no respondio')
+
+    def _request(self, method, path, body=None):
+        self._ensure_server()
+        auth = base64.b64encode(f'{self.user}:{self.password}'.encode()).decode()
+        headers = {'Authorization': f'Basic {auth}', 'Content-Type': 'application/json'}
+        data = json.dumps(body).encode() if body is not None else None
+        for attempt in (1, 2):
+            conn = getattr(self._local, 'conn', None)
+            if conn is None:
+                host, port = self.address.rsplit(':', 1)
+                conn = self._local.conn = http.client.HTTPConnection(host, int(port), timeout=30)
+            try:
+                conn.request(method, path, body=data, headers=headers)
+                resp = conn.getresponse(); payload = resp.read()
+                if resp.status >= 400: raise RuntimeError(f'{method} {path}: HTTP {resp.status}')
+                return json.loads(payload) if payload else {}
+            except (http.client.HTTPException, OSError):
+                # Conexion keep-alive cerrada por el servidor: se reabre una vez
+                conn.close(); self._local.conn = None
+                if attempt == 2: raise
+
+    def _fallback(self, name, *args):
+        fn = getattr(KopiaCLI, name)
+        return fn(self, *args)
+
+    def repo_status(self):
+        try:
+            data = self._request('GET', '/api/v1/repo/status')
+            if not data.get('connected'): return False, None
+            # La ruta de almacenamiento no viene en la API: se toma una vez del CLI
+            if self.repo_path is None: self.repo_path = KopiaCLI.repo_status(self)[1] or "Conectado"
+            return True, self.repo_path
+        except Exception as e:
+            print(f"Kopia Server Error (status): {e}", flush=True); return self._fallback('repo_status')
+
+    def policy_list(self):
+        try: return self._request('GET', '/api/v1/policies').get('policies') or []
+        except Exception as e:
+            print(f"Kopia Server Error (policy): {e}", flush=True); return self._fallback('policy_list')
+
+    def snapshot_list(self, paths=None):
+        try:
+            data = self._request('GET', '/api/v1/sources')
+            host, user = data.get('localHost'), data.get('localUsername')
+            out = []
+            for entry in data.get('sources') or []:
+                src = entry.get('source', {})
+                if src.get('host') != host or src.get('userName') != user: continue
+                if paths and src.get('path') not in paths: continue
+                q = urllib.parse.urlencode({'host': src.get('host', ''), 'userName': src.get('userName', ''), 'path': src.get('path', ''), 'all': '1'})
+                for snap in self._request('GET', f'/api/v1/snapshots?{q}').get('snapshots') or []:
+                    summary = snap.get('summary', {})
+                    out.append({'id': snap.get('id', ''), 'source': src, 'startTime': snap.get('startTime', ''), 'endTime': snap.get('endTime', ''),
+                                'stats': {'totalSize': summary.get('size', 0), 'fileCount': summary.get('files', 0)}, 'rootEntry': {'obj': snap.get('rootID', '')}})
+            return out
+        except Exception as e:
+            print(f"Kopia Server Error (snapshots): {e}", flush=True); return self._fallback('snapshot_list', paths)
+
+    def show_directory(self, oid):
+        # El contenido de un objeto directorio es su manifiesto JSON
+        try: return self._request('GET', f'/api/v1/objects/{oid}').get('entries') or []
+        except Exception as e:
+            print(f"Kopia Server Error (show): {e}", flush=True); return self._fallback('show_directory', oid)
+
+    def restore(self, sid, path, job=None):
+        try:
+            task = self._request('POST', '/api/v1/restore', {'root': sid, 'fsOutput': {'targetPath': path, 'overwriteFiles': True, 'overwriteDirectories': True, 'overwriteSymlinks': True}})
+        except Exception as e:
+            print(f"Kopia Server Error (restore): {e}", flush=True); return self._fallback('restore', sid, path, job)
+        tid = task.get('id')
+        while True:
+            if job and job.cancelled:
+                try: self._request('POST', f'/api/v1/tasks/{tid}/cancel')
+                except Exception: pass
+            try: t = self._request('GET', f'/api/v1/tasks/{tid}')
+            except Exception as e: return False, str(e)
+            counters = t.get('counters') or {}
+            if job:
+                files = sum(v.get('value', 0) for k, v in counters.items() if 'Files' in k)
+                nbytes = sum(v.get('value', 0) for k, v in counters.items() if 'Bytes' in k)
+                job.log(f"Processed {files} ({nbytes} B)")
+            if t.get('status') in ('SUCCESS', 'FAILED', 'CANCELED'):
+                return t.get('status') == 'SUCCESS', t.get('errorMessage', '')
+            time.sleep(1)
+
+    def refresh(self):
+        # Tras cambios hechos por CLI (snapshot create/delete, policy set) el servidor recarga sus manifiestos
+        try: self._request('POST', '/api/v1/refresh')
+        except Exception: pass
+
+    def reset(self):
+        # El repositorio cambio (create/connect/rescate): se reinicia el servidor con la nueva config
+        with self._lock:
+            if self.proc and self.proc.poll() is None:
+                self.proc.terminate()
+                try: self.proc.wait(10)
+                except subprocess.TimeoutExpired: self.proc.kill()
+            self.proc = None; self.repo_path = None
+
+if KOPIA_BACKEND == 'server': kopia_backend = KopiaServer(external=bool(os.environ.get('SHIELDPI_KOPIA_SERVER_EXTERNAL')))
+else: kopia_backend = KopiaCLI()
 
 # --- DATABASE ---
+# Pool de conexiones reutilizables (WAL, cache de sentencias preparadas por conexion). Cada hilo toma una
+# conexion durante un bloque 'with db()' y la devuelve al terminar; commit al salir, rollback si hay excepcion.
+DB_POOL_SIZE = 8
+_db_pool = queue.LifoQueue()
+
+def _db_connect():
+    conn = sqlite3.connect(DB_PATH, timeout=30, check_same_thread=False, cached_statements=256)
+    conn.row_factory = sqlite3.Row
+    conn.execute('PRAGMA journal_mode=WAL'); conn.execute('PRAGMA synchronous=NORMAL')
+    return conn
+
+@contextmanager
+def db():
+    try: conn = _db_pool.get_nowait()
+    except queue.Empty: conn = _db_connect()
+    try:
+        yield conn
+        conn.commit()
+    except:
+        conn.rollback(); raise
+    finally:
+        if _db_pool.qsize() < DB_POOL_SIZE: _db_pool.put(conn)
+        else: conn.close()
+
 def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    c = conn.cursor()
-    c.execute('''CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL UNIQUE, password_hash TEXT NOT NULL)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS docker_links (path TEXT PRIMARY KEY, container_name TEXT)''')
-    c.execute('''CREATE TABLE IF NOT EXISTS cloud_config (id INTEGER PRIMARY KEY CHECK (id = 1), provider TEXT, bucket TEXT, access_key TEXT, secret_key TEXT, endpoint TEXT, region TEXT)''')
-    conn.commit(); conn.close()
+    with db() as conn:
+        c = conn.cursor()
+        c.execute('''CREATE TABLE IF NOT EXISTS users (id INTEGER PRIMARY KEY AUTOINCREMENT, username TEXT NOT NULL UNIQUE, password_hash TEXT NOT NULL)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS docker_links (path TEXT PRIMARY KEY, container_name TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS cloud_config (id INTEGER PRIMARY KEY CHECK (id = 1), provider TEXT, bucket TEXT, access_key TEXT, secret_key TEXT, endpoint TEXT, region TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS snapshots (id TEXT PRIMARY KEY, source TEXT NOT NULL, start_time TEXT, start_ts REAL, size INTEGER, files INTEGER, root_oid TEXT)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_snapshots_source ON snapshots (source, start_ts DESC, id DESC)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS source_runs (id INTEGER PRIMARY KEY AUTOINCREMENT, source TEXT NOT NULL, started REAL, duration REAL, bytes INTEGER, files INTEGER, success INTEGER, attempts INTEGER, error TEXT, skipped INTEGER DEFAULT 0, uploaded INTEGER DEFAULT 0)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS source_manifests (path TEXT PRIMARY KEY, digest TEXT, entries INTEGER, scanned REAL, snapshot_id TEXT)''')
+        c.execute('''CREATE INDEX IF NOT EXISTS idx_source_runs_source ON source_runs (source, started DESC)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS source_schedules (path TEXT PRIMARY KEY, cron TEXT NOT NULL)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, kind TEXT, label TEXT, status TEXT, created REAL, started REAL, finished REAL, message TEXT, last_line TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS sync_runs (id INTEGER PRIMARY KEY AUTOINCREMENT, started REAL, duration REAL, bytes INTEGER, blobs INTEGER, estimated INTEGER, parallel INTEGER, upload_limit INTEGER, success INTEGER, error TEXT)''')
+        c.execute('''CREATE TABLE IF NOT EXISTS rescue_sources (path TEXT PRIMARY KEY, bucket TEXT, snapshot_id TEXT, priority INTEGER, status TEXT, total_bytes INTEGER, bytes INTEGER, started REAL, finished REAL, error TEXT)''')
+        # Trabajos que quedaron a medias por un reinicio del contenedor
+        c.execute("UPDATE jobs SET status = 'interrupted', finished = ? WHERE status IN ('queued', 'running')", (time.time(),))
+        c.execute("UPDATE rescue_sources SET status = 'pending' WHERE status = 'running'")
+
+# --- CACHE DE CONFIGURACION ---
+# settings, cloud_config y docker_links son tablas pequenas: se leen enteras una vez y cada escritura actualiza la cache.
+_config_cache = {}
+_config_lock = threading.Lock()
+
+def _cached(name, loader):
+    with _config_lock:
+        if name not in _config_cache: _config_cache[name] = loader()
+        return _config_cache[name]
+
+def _invalidate_config(name):
+    with _config_lock: _config_cache.pop(name, None)
+
+def _load_settings():
+    with db() as conn: return {r[0]: r[1] for r in conn.execute('SELECT key, value FROM settings')}
 
 def get_setting(key, default=None):
-    conn = sqlite3.connect(DB_PATH); c = conn.cursor()
-    c.execute('SELECT value FROM settings WHERE key = ?', (key,))
-    row = c.fetchone(); conn.close()
-    return row[0] if row else default
+    value = _cached('settings', _load_settings).get(key)
+    return value if value is not None else default
+
+def get_settings(defaults):
+    # Lectura de varias claves de una vez: {clave: valor_por_defecto} -> {clave: valor}
+    current = _cached('settings', _load_settings)
+    return {k: current[k] if current.get(k) is not None else d for k, d in defaults.items()}
 
 def set_setting(key, value):
-    conn = sqlite3.connect(DB_PATH); c = conn.cursor()
-    c.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
-    conn.commit(); conn.close()
+    with db() as conn: conn.execute('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+    _invalidate_config('settings')
 
 def get_docker_link(path):
-    conn = sqlite3.connect(DB_PATH); c = conn.cursor()
-    c.execute('SELECT container_name FROM docker_links WHERE path = ?', (path,))
-    row = c.fetchone(); conn.close()
-    return row[0] if row else None
+    return get_docker_links().get(path)
+
+def get_docker_links():
+    def load():
+        with db() as conn: return {r[0]: r[1] for r in conn.execute('SELECT path, container_name FROM docker_links')}
+    return dict(_cached('docker_links', load))
 
 def set_docker_link(path, container_name):
-    conn = sqlite3.connect(DB_PATH); c = conn.cursor()
-    if container_name: c.execute('INSERT OR REPLACE INTO docker_links (path, container_name) VALUES (?, ?)', (path, container_name))
-    else: c.execute('DELETE FROM docker_links WHERE path = ?', (path,))
-    conn.commit(); conn.close()
+    with db() as conn:
+        if container_name: conn.execute('INSERT OR REPLACE INTO docker_links (path, container_name) VALUES (?, ?)', (path, container_name))
+        else: conn.execute('DELETE FROM docker_links WHERE path = ?', (path,))
+    _invalidate_config('docker_links')
+
+def get_source_schedules():
+    def load():
+        with db() as conn: return {r[0]: r[1] for r in conn.execute('SELECT path, cron FROM source_schedules')}
+    return dict(_cached('source_schedules', load))
+
+def set_source_schedule(path, cron):
+    with db() as conn:
+        if cron: conn.execute('INSERT OR REPLACE INTO source_schedules (path, cron) VALUES (?, ?)', (path, cron))
+        else: conn.execute('DELETE FROM source_schedules WHERE path = ?', (path,))
+    _invalidate_config('source_schedules')
 
 def get_cloud_config():
-    conn = sqlite3.connect(DB_PATH); conn.row_factory = sqlite3.Row
-    c = conn.cursor()
-    c.execute('SELECT * FROM cloud_config WHERE id = 1')
-    row = c.fetchone(); conn.close()
-    return dict(row) if row else None
+    def load():
+        with db() as conn: row = conn.execute('SELECT * FROM cloud_config WHERE id = 1').fetchone()
+        return dict(row) if row else None
+    cfg = _cached('cloud_config', load)
+    return dict(cfg) if cfg else None
 
 def set_cloud_config(provider, bucket, access, secret, endpoint, region):
-    conn = sqlite3.connect(DB_PATH); c = conn.cursor()
-    c.execute('INSERT OR REPLACE INTO cloud_config (id, provider, bucket, access_key, secret_key, endpoint, region) VALUES (1, ?, ?, ?, ?, ?, ?)', 
-              (provider, bucket, access, secret, endpoint, region))
-    conn.commit(); conn.close()
+    with db() as conn:
+        conn.execute('INSERT OR REPLACE INTO cloud_config (id, provider, bucket, access_key, secret_key, endpoint, region) VALUES (1, ?, ?, ?, ?, ?, ?)', 
+                     (provider, bucket, access, secret, endpoint, region))
+    _invalidate_config('cloud_config')
 
-# --- NOTIFICACIONES ---
-def send_notification(message, is_success=True):
-    provider = get_setting('notify_provider', 'none')
-    prefix = "ShieldPi: " if is_success else "ShieldPi Error: "
-    full_msg = prefix + message
+# --- TRABAJOS EN SEGUNDO PLANO ---
+# Las operaciones largas de kopia corren en un pool acotado; las rutas devuelven el id del trabajo al instante
+# y el progreso se consulta por /api/jobs/<id> o se sigue en vivo por SSE.
+_SIZE_UNITS = {'B': 1, 'KB': 10**3, 'MB': 10**6, 'GB': 10**9, 'TB': 10**12, 'KIB': 2**10, 'MIB': 2**20, 'GIB': 2**30, 'TIB': 2**40}
+_PROGRESS_RE = {
+    'hashed': re.compile(r'(\d+) hashed \(([\d.]+ ?[KMGT]?i?B)\)'),
+    'cached': re.compile(r'(\d+) cached \(([\d.]+ ?[KMGT]?i?B)\)'),
+    'processed': re.compile(r'[Pp]rocessed (\d+) \(([\d.]+ ?[KMGT]?i?B)\)'),
+    'uploaded': re.compile(r'uploaded ()([\d.]+ ?[KMGT]?i?B)'),
+}
+
+def parse_size(text):
+    m = re.match(r'([\d.]+) ?([KMGT]?i?B)', text.strip(), re.I)
+    return int(float(m.group(1)) * _SIZE_UNITS.get(m.group(2).upper(), 1)) if m else 0
+
+class Job:
+    def __init__(self, kind, label, key):
+        self.id = uuid.uuid4().hex[:12]; self.kind = kind; self.label = label; self.key = key
+        self.status = 'queued'; self.message = ''; self.progress = {}
+        self.created = time.time(); self.started = None; self.finished = None
+        self.lines = deque(maxlen=JOB_LOG_LINES); self.seq = 0; self.tag_progress = {}
+        self.cond = threading.Condition(); self.cancel_event = threading.Event(); self.procs = set()
+
+    @property
+    def cancelled(self): return self.cancel_event.is_set()
+
+    @property
+    def done(self): return self.status not in ('queued', 'running')
+
+    def log(self, line, tag=None):
+        with self.cond:
+            self.seq += 1; self.lines.append((self.seq, f"[{tag}] {line}" if tag else line))
+            # Con varios origenes en paralelo cada uno lleva sus contadores y el total es la suma
+            prog = self.tag_progress.setdefault(tag, {})
+            for name, rx in _PROGRESS_RE.items():
+                m = rx.search(line)
+                if m:
+                    if m.group(1): prog[f'{name}_files'] = int(m.group(1))
+                    prog[f'{name}_bytes'] = parse_size(m.group(2))
+            for k in prog: self.progress[k] = sum(p.get(k, 0) for p in self.tag_progress.values())
+            elapsed = time.time() - (self.started or self.created)
+            moved = self.progress.get('hashed_bytes', 0) or self.progress.get('processed_bytes', 0)
+            if moved and elapsed > 0: self.progress['throughput'] = int(moved / elapsed)
+            self.cond.notify_all()
+
+    def tagged(self, tag): return _TaggedJob(self, tag)
+
+    def attach(self, proc):
+        with self.cond: self.procs.add(proc)
+        if self.cancelled: proc.terminate()
+
+    def detach(self, proc):
+        with self.cond: self.procs.discard(proc)
+
+    def cancel(self):
+        self.cancel_event.set()
+        with self.cond: procs = list(self.procs)
+        for proc in procs:
+            try: proc.terminate()
+            except Exception: pass
+
+    def set_status(self, status, message=None):
+        with self.cond:
+            self.status = status
+            if message is not None: self.message = message
+            if status == 'running': self.started = time.time()
+            elif self.done: self.finished = time.time()
+            self.cond.notify_all()
+        save_job(self)
+
+    def to_dict(self):
+        with self.cond:
+            return {'id': self.id, 'kind': self.kind, 'label': self.label, 'status': self.status, 'message': self.message,
+                    'progress': dict(self.progress), 'last_line': self.lines[-1][1] if self.lines else '',
+                    'created': self.created, 'started': self.started, 'finished': self.finished}
+
+class _TaggedJob:
+    # Vista de un trabajo que antepone el origen a cada linea (para procesos kopia en paralelo)
+    def __init__(self, job, tag): self.job = job; self.tag = tag
+    @property
+    def cancelled(self): return self.job.cancelled
+    def log(self, line): self.job.log(line, self.tag)
+    def attach(self, proc): self.job.attach(proc)
+    def detach(self, proc): self.job.detach(proc)
+
+_jobs = {}
+_jobs_lock = threading.Lock()
+_job_pool = ThreadPoolExecutor(max_workers=JOB_WORKERS, thread_name_prefix='job')
+
+def save_job(job):
+    d = job.to_dict()
+    with db() as conn:
+        conn.execute('INSERT OR REPLACE INTO jobs (id, kind, label, status, created, started, finished, message, last_line) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (d['id'], d['kind'], d['label'], d['status'], d['created'], d['started'], d['finished'], d['message'], d['last_line']))
+
+def load_job(job_id):
+    with db() as conn: row = conn.execute('SELECT * FROM jobs WHERE id = ?', (job_id,)).fetchone()
+    return dict(row, progress={}) if row else None
+
+def get_job(job_id):
+    with _jobs_lock: return _jobs.get(job_id)
+
+def active_jobs():
+    with _jobs_lock: return [j for j in _jobs.values() if not j.done]
+
+def _run_job(job, fn, args):
+    if job.cancelled: job.set_status('cancelled', 'Cancelado antes de iniciar.'); return
+    job.set_status('running')
     try:
-        if provider == 'telegram':
-            token = get_setting('notify_token'); chatid = get_setting('notify_chatid')
-            if token and chatid:
-                url = f"https://api.telegram.org/bot{token}/sendMessage"
-                data = urllib.parse.urlencode({'chat_id': chatid, 'text': full_msg}).encode()
-                urllib.request.urlopen(url, data=data)
-        elif provider == 'webhook':
-            url = get_setting('notify_url')
-            if url:
-                headers = {'Content-Type': 'application/json'}
-                data = json.dumps({'content': full_msg, 'message': full_msg, 'priority': 5}).encode()
-                req = urllib.request.Request(url, data=data, headers=headers)
-                urllib.request.urlopen(req)
-        return True
+        ok, message = fn(job, *args)
+        status = 'cancelled' if job.cancelled else ('done' if ok else 'error')
     except Exception as e:
-        print(f"Error Notif: {e}"); return False
+        print(f"Job Error ({job.kind}): {e}", flush=True); status, message = 'error', str(e)
+    job.set_status(status, message)
+
+def submit_job(kind, fn, *args, label=None, key=None):
+    # Un solo trabajo activo por clave: repetir el boton devuelve el que ya esta en curso
+    key = key or kind
+    with _jobs_lock:
+        for j in _jobs.values():
+            if j.key == key and not j.done: return j
+        finished = sorted((j for j in _jobs.values() if j.done), key=lambda j: j.finished or 0)
+        for j in finished[:max(0, len(_jobs) - 50)]: del _jobs[j.id]
+        job = Job(kind, label or kind, key); _jobs[job.id] = job
+    save_job(job)
+    _job_pool.submit(_run_job, job, fn, args)
+    return job
+
+def job_response(job, endpoint, **values):
+    if request.is_json or request.accept_mimetypes.best == 'application/json': return jsonify(job.to_dict()), 202
+    return redirect(url_for(endpoint, job=job.id, **values))
+
+# --- NOTIFICACIONES ---
+# send_notification solo encola: notification_loop agrupa las rafagas en un resumen y lo entrega a todos los
+# proveedores activos en paralelo, con timeout, reintentos con espera exponencial y conexiones keep-alive por host.
+_notify_queue = queue.Queue()
+_notify_pool = ThreadPoolExecutor(max_workers=4, thread_name_prefix='notify')
+_notify_local = threading.local()
+
+def notification_requests(text):
+    # [(proveedor, url, cuerpo, content-type)] segun la configuracion; notify_provider es una lista separada por comas
+    cfg = get_settings({'notify_provider': 'none', 'notify_token': '', 'notify_chatid': '', 'notify_url': ''})
+    providers = cfg['notify_provider'].split(','); reqs = []
+    if 'telegram' in providers and cfg['notify_token'] and cfg['notify_chatid']:
+        reqs.append(('telegram', f"{TELEGRAM_API}/bot{cfg['notify_token']}/sendMessage",
+                     urllib.parse.urlencode({'chat_id': cfg['notify_chatid'], 'text': text}).encode(), 'application/x-www-form-urlencoded'))
+    if 'webhook' in providers:
+        data = json.dumps({'content': text, 'message': text, 'priority': 5}).encode()
+        reqs += [('webhook', url, data, 'application/json') for url in re.split(r'[\s,]+', cfg['notify_url']) if url]
+    return reqs
+
+def _http_post(url, body, content_type):
+    u = urllib.parse.urlsplit(url); key = (u.scheme, u.netloc)
+    conns = getattr(_notify_local, 'conns', None)
+    if conns is None: conns = _notify_local.conns = {}
+    path = (u.path or '/') + (f'?{u.query}' if u.query else '')
+    for attempt in (1, 2):
+        conn = conns.get(key)
+        if conn is None:
+            cls = http.client.HTTPSConnection if u.scheme == 'https' else http.client.HTTPConnection
+            conn = conns[key] = cls(u.netloc, timeout=NOTIFY_TIMEOUT)
+        try:
+            conn.request('POST', path, body=body, headers={'Content-Type': content_type})
+            resp = conn.getresponse(); resp.read()
+            return resp.status
+        except (http.client.HTTPException, OSError):
+            # Conexion keep-alive cerrada por el otro lado: se reabre una vez antes de contar como fallo
+            conn.close(); conns.pop(key, None)
+            if attempt == 2: raise
+
+def _deliver(provider, url, body, content_type, retries):
+    delay = 1
+    for attempt in range(retries + 1):
+        try:
+            status = _http_post(url, body, content_type)
+            if status < 400: return True
+            err = f"HTTP {status}"
+            # Un 4xx (token o chat mal configurado) no se arregla reintentando
+            if status < 500 and status != 429: break
+        except (http.client.HTTPException, OSError) as e: err = str(e)
+        if attempt < retries: time.sleep(delay); delay *= 2
+    print(f"Error Notif ({provider}): {err}", flush=True); return False
+
+def deliver_notification(text, retries=NOTIFY_RETRIES):
+    reqs = notification_requests(text)
+    return all(_notify_pool.map(lambda r: _deliver(*r, retries), reqs))
+
+def format_digest(items):
+    if len(items) == 1: return ("ShieldPi: " if items[0][1] else "ShieldPi Error: ") + items[0][0]
+    errors = sum(1 for _, ok in items if not ok)
+    head = f"ShieldPi: {len(items)} avisos" + (f" ({errors} con error)" if errors else "")
+    return head + "\n" + "\n".join(f"- {'' if ok else 'Error: '}{msg}" for msg, ok in items)
+
+def send_notification(message, is_success=True):
+    _notify_queue.put((message, is_success)); return True
+
+def notification_loop():
+    while True:
+        items = [_notify_queue.get()]
+        # Lo que llegue durante la ventana de agrupacion sale en el mismo mensaje
+        deadline = time.time() + NOTIFY_COALESCE
+        while time.time() < deadline:
+            try: items.append(_notify_queue.get(timeout=max(0, deadline - time.time())))
+            except queue.Empty: break
+        try: deliver_notification(format_digest(items))
+        except Exception as e: print(f"Error Notif: {e}", flush=True)
 
 # --- FUNCIONES KOPIA ---
 def get_repo_status():
     if not os.path.exists(KOPIA_CONFIG): return False, None
-    success, out, _ = run_kopia(['repository', 'status', '--json'])
-    if success:
-        try:
-            data = json.loads(out)
-            return True, data.get('storage', {}).get('config', {}).get('path', 'Desconocido')
-        except: return True, "Conectado"
-    return False, None
+    return kopia_backend.repo_status()
+
+# --- CATALOGO DE POLITICAS (cache en memoria) ---
+# Una sola llamada a 'policy list' trae todas las reglas y una sola consulta SQL los vinculos Docker.
+_policy_cache = {'sources': None}
+_policy_lock = threading.Lock()
+
+def _extract_ignores(pol_data):
+    files = pol_data.get('files', {}) if isinstance(pol_data, dict) else {}
+    if not files: files = pol_data.get('definition', {}).get('files', {}) if isinstance(pol_data, dict) else {}
+    ignores = files.get('ignore', [])
+    if not ignores: ignores = files.get('ignoreRules', [])
+    return ignores if isinstance(ignores, list) else []
+
+def load_policy_catalog():
+    policies_raw = kopia_backend.policy_list()
+    if policies_raw is None: return None
+    links = get_docker_links(); schedules = get_source_schedules(); by_path = {}
+    for p in policies_raw or []:
+        path = p.get('target', {}).get('path', '')
+        if not path: continue
+        pol = p.get('policy')
+        if pol is None:
+            # Version de kopia sin la politica embebida en el listado: fallback puntual
+            s, o, _ = run_kopia(['policy', 'get', path, '--json'])
+            try: pol = json.loads(o) if s else {}
+            except: pol = {}
+        ignores = _extract_ignores(pol)
+        if path in by_path: by_path[path]['ignores'] = by_path[path]['ignores'] or ignores
+        else: by_path[path] = {'path': path, 'ignores': ignores, 'docker_link': links.get(path), 'schedule': schedules.get(path), 'quiesce': get_quiesce(path) if links.get(path) else None}
+    return sorted(by_path.values(), key=lambda x: x['path'])
 
 def get_policies():
-    success, out, _ = run_kopia(['policy', 'list', '--json'])
-    sources = []
-    if success:
-        try:
-            policies_raw = json.loads(out)
-            unique_paths = set()
-            for p in policies_raw:
-                path = p.get('target', {}).get('path', ''); 
-                if path: unique_paths.add(path)
-            for path in unique_paths:
-                s, o, _ = run_kopia(['policy', 'get', path, '--json'])
-                ignores = []
-                if s:
-                    try:
-                        pol_data = json.loads(o)
-                        files = pol_data.get('files', {})
-                        if not files: files = pol_data.get('definition', {}).get('files', {})
-                        ignores = files.get('ignore', [])
-                        if not ignores: ignores = files.get('ignoreRules', [])
-                    except: pass
-                if not isinstance(ignores, list): ignores = []
-                d_link = get_docker_link(path)
-                sources.append({'path': path, 'ignores': ignores, 'docker_link': d_link})
-            sources.sort(key=lambda x: x['path'])
-        except: pass
-    return sources
+    with _policy_lock:
+        if _policy_cache['sources'] is None:
+            _policy_cache['sources'] = load_policy_catalog()
+        cached = _policy_cache['sources'] or []
+    return [dict(s, ignores=list(s['ignores'])) for s in cached]
+
+def invalidate_policies():
+    kopia_backend.refresh()
+    with _policy_lock: _policy_cache['sources'] = None
+
+def format_snapshot_time(raw_time):
+    try:
+        dt_utc = datetime.fromisoformat(raw_time.replace('Z', '+00:00'))
+        return dt_utc.astimezone(LOCAL_TZ).strftime('%Y-%m-%d %I:%M %p')
+    except: return raw_time
+
+def format_timestamp(ts):
+    return datetime.fromtimestamp(ts, LOCAL_TZ).strftime('%Y-%m-%d %I:%M %p') if ts else None
+
+def format_size(sz):
+    szs = f"{sz} B"
+    if sz > 1024: szs = f"{sz/1024:.1f} KB"
+    if sz > 1048576: szs = f"{sz/1048576:.1f} MB"
+    return szs
+
+def _snapshot_ts(raw_time):
+    # kopia usa RFC3339 con nanosegundos; se recorta a microsegundos para fromisoformat
+    try:
+        base, _, frac = raw_time.replace('Z', '').partition('.')
+        return datetime.fromisoformat(f"{base}.{(frac + '000000')[:6]}+00:00").timestamp()
+    except: return 0.0
+
+# --- INDICE LOCAL DE SNAPSHOTS ---
+# Copia en shieldpi.db del listado de kopia; se reconcilia por origen (solo altas y bajas) tras cada backup o borrado.
+def sync_snapshot_index(paths=None):
+    if paths: kopia_backend.refresh()
+    snaps = kopia_backend.snapshot_list(paths)
+    if snaps is None: return False
+    rows = {}
+    for x in snaps:
+        sid = x.get('id', ''); src = x.get('source', {}).get('path', '')
+        if not sid or not src: continue
+        st = x.get('stats', {})
+        rows[sid] = (sid, src, x.get('startTime', ''), _snapshot_ts(x.get('startTime', '')), st.get('totalSize', 0), st.get('fileCount', 0), x.get('rootEntry', {}).get('obj', ''))
+    with db() as conn:
+        c = conn.cursor()
+        if paths: c.execute(f"SELECT id FROM snapshots WHERE source IN ({','.join('?' * len(paths))})", list(paths))
+        else: c.execute('SELECT id FROM snapshots')
+        known = {r[0] for r in c.fetchall()}
+        c.executemany('INSERT OR REPLACE INTO snapshots (id, source, start_time, start_ts, size, files, root_oid) VALUES (?, ?, ?, ?, ?, ?, ?)', [rows[i] for i in rows.keys() - known])
+        c.executemany('DELETE FROM snapshots WHERE id = ?', [(i,) for i in known - rows.keys()])
+    return True
+
+def remove_snapshot_index(sid):
+    with db() as conn: conn.execute('DELETE FROM snapshots WHERE id = ?', (sid,))
+
+def clear_snapshot_index():
+    with db() as conn: conn.execute('DELETE FROM snapshots')
+    clear_source_manifest()
+
+def source_indexed(path):
+    with db() as conn: row = conn.execute('SELECT 1 FROM snapshots WHERE source = ? LIMIT 1', (path,)).fetchone()
+    return row is not None
+
+def query_snapshots(path, cursor=None, limit=50):
+    # Paginacion por keyset sobre (start_ts, id), del mas nuevo al mas viejo
+    sql = 'SELECT id, start_time, start_ts, size, files FROM snapshots WHERE source = ?'; args = [path]
+    if cursor:
+        # Un cursor que no se puede leer se ignora (primera pagina) en vez de dejar parametros sin valor
+        ts, _, sid = cursor.partition(':')
+        try: ts = float(ts)
+        except ValueError: cursor = None
+        if cursor: sql += ' AND (start_ts < ? OR (start_ts = ? AND id < ?))'; args += [ts, ts, sid]
+    with db() as conn: rows = conn.execute(sql + ' ORDER BY start_ts DESC, id DESC LIMIT ?', args + [limit + 1]).fetchall()
+    snaps = [{'id': r[0], 'short_id': r[0][:8], 'time': format_snapshot_time(r[1]), 'size': format_size(r[3] or 0), 'files': r[4] or 0} for r in rows[:limit]]
+    next_cursor = f"{rows[limit - 1][2]}:{rows[limit - 1][0]}" if len(rows) > limit else None
+    return snaps, next_cursor
 
 def get_last_snapshot_time():
-    success, out, _ = run_kopia(['snapshot', 'list', '--json'])
-    if success:
-        try:
-            data = json.loads(out)
-            if data and len(data) > 0:
-                data.sort(key=lambda x: x.get('startTime', ''), reverse=True)
-                raw_time = data[0].get('startTime', '')
-                try: 
-                    dt_utc = datetime.fromisoformat(raw_time.replace('Z', '+00:00'))
-                    dt_local = dt_utc.astimezone(LOCAL_TZ) 
-                    return dt_local.strftime('%Y-%m-%d %I:%M %p')
-                except: return raw_time
-        except: pass
-    return "Nunca"
+    with db() as conn: row = conn.execute('SELECT start_time FROM snapshots ORDER BY start_ts DESC LIMIT 1').fetchone()
+    return format_snapshot_time(row[0]) if row else "Nunca"
+
+# --- ESTADO DEL REPOSITORIO (cache con refresco en segundo plano) ---
+# El dashboard lee de memoria; si el estado esta vencido se sirve igual y se pide un refresco (stale-while-revalidate).
+# Sin visitas no se refresca nada: el hilo solo despierta cuando get_repo_state() o una tarea lo piden.
+REPO_STATE_TTL = int(os.environ.get('SHIELDPI_STATE_TTL', '60'))
+_repo_state = {'connected': False, 'repo_path': None, 'sources': [], 'last_backup': 'Nunca', 'updated': 0}
+_repo_state_lock = threading.Lock()
+_repo_state_event = threading.Event()
+
+def refresh_repo_state():
+    connected, repo_path = get_repo_status()
+    sources, last_backup = [], 'Nunca'
+    if connected:
+        # El catalogo de politicas sigue en cache: lo invalidan las rutas que lo cambian (reload_sources)
+        sources = get_policies()
+        sync_snapshot_index(); last_backup = get_last_snapshot_time()
+    update_repo_state(connected=connected, repo_path=repo_path, sources=sources, last_backup=last_backup)
+
+def update_repo_state(**fields):
+    with _repo_state_lock:
+        _repo_state.update(fields); _repo_state['updated'] = time.time()
+
+def request_repo_refresh(): _repo_state_event.set()
+
+def get_repo_state():
+    with _repo_state_lock: state = dict(_repo_state)
+    if not state['updated']:
+        refresh_repo_state()
+        with _repo_state_lock: state = dict(_repo_state)
+    elif time.time() - state['updated'] > REPO_STATE_TTL: request_repo_refresh()
+    return state
+
+def reload_sources():
+    invalidate_policies(); update_repo_state(sources=get_policies())
+
+def mark_backup_done():
+    update_repo_state(last_backup=get_last_snapshot_time())
+
+def repo_state_loop():
+    while True:
+        _repo_state_event.wait(); _repo_state_event.clear()
+        try: refresh_repo_state()
+        except Exception as e: print(f"Repo State Error: {e}", flush=True)
 
 # --- SCHEDULER ---
+# Cada horario (el global y los de cada origen) es una expresion cron. El hilo duerme hasta el proximo disparo del
+# heap o hasta que notify_scheduler() avisa de un cambio de configuracion; en reposo no consulta la base de datos.
+# 'sched_last:<clave>' guarda el ultimo disparo: si al arrancar hay uno perdido, se ejecuta en el momento.
+_CRON_RANGES = [(0, 59), (0, 23), (1, 31), (1, 12), (0, 7)]
+_sched_event = threading.Event()
+_sched_next = {}
+
+def parse_cron(expr):
+    fields = (expr or '').split()
+    if len(fields) != 5: raise ValueError(f"Cron invalido (se esperan 5 campos): {expr}")
+    sets = []
+    for field, (lo, hi) in zip(fields, _CRON_RANGES):
+        vals = set()
+        for part in field.split(','):
+            rng, _, step = part.partition('/')
+            try:
+                step = int(step) if step else 1
+                if rng == '*': a, b = lo, hi
+                elif '-' in rng: a, b = (int(x) for x in rng.split('-', 1))
+                else: a = int(rng); b = hi if step > 1 else a
+            except ValueError: raise ValueError(f"Cron invalido: {field}")
+            if a < lo or b > hi or a > b or step < 1: raise ValueError(f"Cron fuera de rango: {field}")
+            vals.update(range(a, b + 1, step))
+        sets.append(vals)
+    if 7 in sets[4]: sets[4] = (sets[4] - {7}) | {0}
+    return sets, fields[2] != '*', fields[4] != '*'
+
+def next_cron_time(expr, after):
+    (minutes, hours, days, months, dows), dom_set, dow_set = parse_cron(expr)
+    t = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+    for _ in range(20000):
+        if t.month not in months:
+            t = (t.replace(day=1, hour=0, minute=0) + timedelta(days=32)).replace(day=1); continue
+        dom_ok = t.day in days; dow_ok = (t.weekday() + 1) % 7 in dows
+        # Como en cron: si se restringen dia del mes y dia de la semana basta con que coincida uno
+        if not ((dom_ok or dow_ok) if dom_set and dow_set else (dom_ok and dow_ok)):
+            t = t.replace(hour=0, minute=0) + timedelta(days=1); continue
+        if t.hour not in hours: t = t.replace(minute=0) + timedelta(hours=1); continue
+        if t.minute not in minutes: t += timedelta(minutes=1); continue
+        return t
+    raise ValueError(f"Cron sin proxima ejecucion: {expr}")
+
+def load_schedules():
+    cfg = get_settings({'freq': 'manual', 'time': '03:00', 'cron': ''})
+    schedules = {}
+    if cfg['freq'] == 'daily':
+        h, m = (cfg['time'] or '03:00').split(':')
+        schedules['global'] = f"{int(m)} {int(h)} * * *"
+    elif cfg['freq'] == 'cron' and cfg['cron']: schedules['global'] = cfg['cron']
+    schedules.update(get_source_schedules())
+    return schedules
+
+def notify_scheduler(): _sched_event.set()
+
+def next_scheduled_run():
+    return min(_sched_next.values(), default=None)
+
+def _build_schedule_heap():
+    now = datetime.now(LOCAL_TZ); heap = []
+    for key, expr in load_schedules().items():
+        last = get_setting(f'sched_last:{key}')
+        if not last:
+            # Horario nuevo: se ancla en este momento para poder detectar disparos perdidos tras un reinicio
+            set_setting(f'sched_last:{key}', str(now.timestamp())); last = now.timestamp()
+        try: nxt = next_cron_time(expr, datetime.fromtimestamp(float(last), LOCAL_TZ))
+        except ValueError as e: print(f"Scheduler: {key}: {e}", flush=True); continue
+        heapq.heappush(heap, (nxt.timestamp(), key, expr))
+    return heap
+
+def fire_schedule(key):
+    set_setting(f'sched_last:{key}', str(time.time()))
+    sources = get_policies()
+    if key == 'global':
+        paths = [x['path'] for x in sources if not x.get('schedule')]
+        if not paths: return
+        print(f"--- Auto Backup: {datetime.now(LOCAL_TZ).strftime('%Y-%m-%d %H:%M')} ---", flush=True)
+        submit_job('backup', do_backup, True, paths, label='Backup Programado')
+    elif any(x['path'] == key for x in sources):
+        print(f"--- Auto Backup: {key} ---", flush=True)
+        submit_job('backup', do_backup, True, [key], label=f'Backup {key}', key=f'backup:{key}')
+
 def scheduler_loop():
     while True:
         try:
-            freq = get_setting('freq', 'manual'); target_time = get_setting('time', '03:00'); last_run_date = get_setting('last_run_date', '')
-            if freq == 'daily':
-                now = datetime.now(LOCAL_TZ)
-                current_time_str = now.strftime('%H:%M'); today_str = now.strftime('%Y-%m-%d')
-                if current_time_str == target_time and last_run_date != today_str:
-                    sources = get_policies(); paths = [s['path'] for s in sources]
-                    if paths:
-                        print(f"--- Auto Backup: {today_str} ---", flush=True)
-                        success, _, err = run_kopia(['snapshot', 'create'] + paths)
-                        if success: 
-                            set_setting('last_run_date', today_str)
-                            
-                            # Mantenimiento para aplicar retencion
-                            run_kopia(['maintenance', 'run', '--full'])
-                            
-                            sync_msg = ""
-                            cloud_cfg = get_cloud_config()
-                            if cloud_cfg:
-                                print("--- Auto Sync Nube ---", flush=True)
-                                cmd_sync = ['repository', 'sync-to', 's3', '--delete', '--bucket', cloud_cfg['bucket'], '--access-key', cloud_cfg['access_key'], '--secret-access-key', cloud_cfg['secret_key']]
-                                if cloud_cfg['endpoint']: cmd_sync.extend(['--endpoint', cloud_cfg['endpoint']])
-                                if cloud_cfg['region']: cmd_sync.extend(['--region', cloud_cfg['region']])
-                                s_sync, _, err_sync = run_kopia(cmd_sync)
-                                if s_sync: sync_msg = " + Sync Nube OK"
-                                else: print(f"Error Sync: {err_sync}", flush=True); sync_msg = f" + Error Nube"
-                            send_notification(f"Ciclo Diario Completado: Backup Local OK {sync_msg}")
-                        else: send_notification(f"Fallo Backup Local: {err}", is_success=False)
-        except Exception as e: print(f"Scheduler Error: {e}", flush=True)
-        time.sleep(60)
+            heap = _build_schedule_heap()
+            while True:
+                _sched_next.clear(); _sched_next.update({key: ts for ts, key, _ in heap})
+                wait = max(0, heap[0][0] - time.time()) if heap else None
+                # Tope de una hora por si el reloj del sistema salta; al despertar solo se mira el heap en memoria
+                if _sched_event.wait(min(wait, 3600) if wait is not None else None):
+                    _sched_event.clear(); break
+                if not heap or heap[0][0] > time.time(): continue
+                due, key, expr = heapq.heappop(heap)
+                observe('shieldpi_scheduler_lag_seconds', time.time() - due); inc('shieldpi_scheduler_fired_total', schedule=key)
+                fire_schedule(key)
+                heapq.heappush(heap, (next_cron_time(expr, datetime.now(LOCAL_TZ)).timestamp(), key, expr))
+        except Exception as e:
+            print(f"Scheduler Error: {e}", flush=True); time.sleep(60)
+
+# --- CONTENEDORES DOCKER ---
+# Control de contenedores por el SDK de docker (CLI si el SDK o el socket no estan). La lista de contenedores se
+# mantiene al dia con el stream de eventos. Los vinculados a un origen se congelan (pause o hook pre/post) solo
+# mientras dura su propio snapshot, y si un origen tiene varios se congelan todos en paralelo.
+QUIESCE_MODES = ('pause', 'hook', 'none')
+
+def get_quiesce(path):
+    try: cfg = json.loads(get_setting(f'quiesce:{path}') or '{}')
+    except ValueError: cfg = {}
+    return {'mode': cfg.get('mode') if cfg.get('mode') in QUIESCE_MODES else 'pause', 'pre': cfg.get('pre', ''), 'post': cfg.get('post', '')}
+
+def set_quiesce(path, mode, pre='', post=''):
+    set_setting(f'quiesce:{path}', json.dumps({'mode': mode, 'pre': pre, 'post': post}) if mode else None)
+
+def linked_containers(path):
+    return [n.strip() for n in (get_docker_link(path) or '').split(',') if n.strip()]
+
+class DockerControl:
+    def __init__(self):
+        self._client = None; self._retry_at = 0; self._names = None; self._watching = False; self._cli_names = (0, None)
+        # Congelaciones compartidas: nombre -> [origenes que lo usan, cfg con la que se congelo o None, inicio]
+        self._holds = {}; self._gates = {}
+        self._lock = threading.Lock()
+
+    def client(self):
+        with self._lock:
+            if self._client is None and docker is not None and time.time() >= self._retry_at:
+                try: self._client = docker.from_env(timeout=30); self._client.ping()
+                except Exception as e:
+                    print(f"Docker SDK no disponible, se usa la CLI: {e}", flush=True)
+                    self._client = None; self._retry_at = time.time() + 60
+            return self._client
+
+    def containers(self):
+        with self._lock: names = self._names
+        if names is not None: return names
+        client = self.client()
+        if client is None:
+            # Sin SDK no hay eventos: la lista de la CLI se guarda unos segundos para no lanzar 'docker ps' en cada peticion
+            with self._lock: expires, names = self._cli_names
+            if names is not None and time.time() < expires: return names
+            s, o, _ = run_command(['docker', 'ps', '--format', '{{.Names}}', '-a'])
+            names = sorted(l.strip() for l in o.splitlines() if l.strip()) if s else []
+            with self._lock: self._cli_names = (time.time() + 10, names)
+            return names
+        names = self._list(client)
+        with self._lock:
+            start = not self._watching; self._watching = True
+        if start: threading.Thread(target=self._watch, daemon=True).start()
+        return names
+
+    def _list(self, client):
+        names = sorted(c.name for c in client.containers.list(all=True))
+        with self._lock: self._names = names
+        return names
+
+    def _watch(self):
+        # Crear, borrar o renombrar un contenedor vuelve a listar; si el stream se corta la lista deja de ser fiable
+        while True:
+            try:
+                client = self.client()
+                if client is None: break
+                for _ in client.events(decode=True, filters={'type': 'container', 'event': ['create', 'destroy', 'rename']}): self._list(client)
+            except Exception as e: print(f"Docker Events Error: {e}", flush=True)
+            with self._lock: self._names = None
+            time.sleep(10)
+        with self._lock: self._watching = False
+
+    def _run(self, action, name, *args):
+        # action: pause, unpause, stop, start o exec (args = comando sh); devuelve (ok, detalle)
+        client = self.client()
+        try:
+            if client is None:
+                cmd = ['docker', 'exec', name, 'sh', '-c', args[0]] if action == 'exec' else ['docker', action, name]
+                s, o, e = run_command(cmd)
+                return s, (o or e).strip()
+            c = client.containers.get(name)
+            if action == 'exec':
+                code, out = c.exec_run(['sh', '-c', args[0]])
+                return code == 0, (out or b'').decode(errors='replace').strip()
+            getattr(c, action)(); return True, ''
+        except Exception as e: return False, str(e)
+
+    def status(self, name):
+        client = self.client()
+        if client is None:
+            s, o, _ = run_command(['docker', 'inspect', '--format', '{{.State.Status}}', name])
+            return o.strip() if s else None
+        try: return client.containers.get(name).status
+        except Exception: return None
+
+    def _parallel(self, fn, names):
+        if len(names) == 1: return [fn(names[0])]
+        with ThreadPoolExecutor(max_workers=len(names), thread_name_prefix='docker') as pool: return list(pool.map(fn, names))
+
+    def _freeze(self, name, cfg, job):
+        # Devuelve el nombre si hay que deshacer algo despues
+        if self.status(name) != 'running': return None
+        if cfg['mode'] == 'hook':
+            if not cfg['pre']: return name
+            ok, out = self._run('exec', name, cfg['pre'])
+            if job: job.log(f"Hook previo en {name}: {'OK' if ok else 'Error'} {out[-200:]}")
+            return name
+        ok, out = self._run('pause', name)
+        if job: job.log(f"Contenedor {name} pausado" if ok else f"No se pudo pausar {name}: {out}")
+        return name if ok else None
+
+    def _gate(self, name):
+        with self._lock: return self._gates.setdefault(name, threading.Lock())
+
+    def _hold(self, name, cfg, job):
+        # Origenes en paralelo que comparten contenedor: el primero lo congela y los demas solo suman
+        with self._gate(name):
+            with self._lock: hold = self._holds.setdefault(name, [0, None, 0]); hold[0] += 1; first = hold[0] == 1
+            if first:
+                if self._freeze(name, cfg, job): hold[1] = cfg; hold[2] = time.time()
+            elif job: job.log(f"Contenedor {name} ya congelado por otro origen" if hold[1] else f"Contenedor {name} compartido con otro origen")
+
+    def _release(self, name, job):
+        # El ultimo en salir deshace la congelacion, con la configuracion del que la hizo
+        with self._gate(name):
+            with self._lock:
+                hold = self._holds[name]; hold[0] -= 1
+                if hold[0]: return
+                del self._holds[name]
+            if hold[1]: self._thaw(name, hold[1], job, hold[2])
+
+    def _thaw(self, name, cfg, job, since):
+        if cfg['mode'] == 'hook':
+            ok, out = self._run('exec', name, cfg['post']) if cfg['post'] else (True, '')
+            if job and cfg['post']: job.log(f"Hook posterior en {name}: {'OK' if ok else 'Error'} {out[-200:]}")
+        else:
+            ok, out = self._run('unpause', name)
+            if job: job.log(f"Contenedor {name} reanudado tras {time.time() - since:.1f}s" if ok else f"Error reanudando {name}: {out}")
+        observe('shieldpi_docker_quiesce_seconds', time.time() - since, container=name)
+
+    @contextmanager
+    def quiesced(self, path, job=None):
+        names = linked_containers(path); cfg = get_quiesce(path)
+        if not names or cfg['mode'] == 'none': yield; return
+        self._parallel(lambda n: self._hold(n, cfg, job), names)
+        try: yield
+        finally: self._parallel(lambda n: self._release(n, job), names)
+
+    @contextmanager
+    def stopped(self, path, job=None):
+        # Restauracion: los archivos cambian bajo el proceso, asi que aqui si se detiene (y solo se arranca lo detenido)
+        names = [n for n in linked_containers(path) if self.status(n) in ('running', 'paused')]
+        stopped = [n for n, (ok, _) in zip(names, self._parallel(lambda n: self._run('stop', n), names)) if ok] if names else []
+        if job and stopped: job.log(f"Detenidos: {', '.join(stopped)}")
+        try: yield
+        finally:
+            if stopped: self._parallel(lambda n: self._run('start', n), stopped)
+
+docker_control = DockerControl()
+
+# --- EJECUTOR DE SNAPSHOTS POR ORIGEN ---
+# Cada origen es un 'snapshot create' propio: corren en paralelo hasta 'backup_parallel', los que mas tardaron
+# la ultima vez arrancan primero y un fallo solo reintenta ese origen.
+def last_source_durations():
+    with db() as conn: rows = conn.execute('SELECT source, duration FROM source_runs r WHERE success = 1 AND skipped = 0 AND started = (SELECT max(started) FROM source_runs WHERE source = r.source AND success = 1 AND skipped = 0)').fetchall()
+    return {r[0]: r[1] for r in rows}
+
+def record_source_run(source, started, duration, nbytes, files, success, attempts, error, skipped=False, uploaded=0):
+    if success and not skipped: observe('shieldpi_source_backup_duration_seconds', duration, source=source)
+    inc('shieldpi_source_runs_total', source=source, result='skipped' if skipped else ('ok' if success else 'error'))
+    with db() as conn:
+        conn.execute('INSERT INTO source_runs (source, started, duration, bytes, files, success, attempts, error, skipped, uploaded) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                     (source, started, duration, nbytes, files, 1 if success else 0, attempts, error, 1 if skipped else 0, uploaded))
+
+def latest_indexed_snapshot(path):
+    with db() as conn: row = conn.execute('SELECT id, size, files FROM snapshots WHERE source = ? ORDER BY start_ts DESC LIMIT 1', (path,)).fetchone()
+    return row
+
+# --- DETECCION DE CAMBIOS (pre-escaneo) ---
+# Antes de lanzar kopia se recorre el origen con os.scandir y se resume (ruta, modo, tamano, mtime, inodo, duenio)
+# de cada entrada en un digest. Si coincide con el del ultimo snapshot correcto, el origen no cambio y se omite.
+# El digest va atado al ID de ese snapshot: si ya no es el ultimo del indice (borrado, otro repositorio) no se omite.
+def scan_source(path):
+    h = hashlib.blake2b(digest_size=16); entries = 0; stack = [path]
+    while stack:
+        d = stack.pop()
+        try:
+            with os.scandir(d) as it: items = sorted(it, key=lambda e: e.name)
+        except OSError:
+            h.update(f"!{d}\n".encode()); continue
+        for e in items:
+            try: st = e.stat(follow_symlinks=False)
+            except OSError: continue
+            h.update(f"{e.path}\0{st.st_mode}\0{st.st_size}\0{st.st_mtime_ns}\0{st.st_ino}\0{st.st_uid}\0{st.st_gid}\n".encode()); entries += 1
+            if e.is_dir(follow_symlinks=False): stack.append(e.path)
+    return h.hexdigest(), entries
+
+def get_source_manifest(path):
+    with db() as conn: row = conn.execute('SELECT digest, snapshot_id FROM source_manifests WHERE path = ?', (path,)).fetchone()
+    return (row[0], row[1]) if row else (None, None)
+
+def save_source_manifest(path, digest, entries, snapshot_id):
+    with db() as conn: conn.execute('INSERT OR REPLACE INTO source_manifests (path, digest, entries, scanned, snapshot_id) VALUES (?, ?, ?, ?, ?)', (path, digest, entries, time.time(), snapshot_id))
+
+def clear_source_manifest(path=None):
+    # Sin ruta: todos (el indice de snapshots se vacio o cambio el repositorio)
+    with db() as conn:
+        if path: conn.execute('DELETE FROM source_manifests WHERE path = ?', (path,))
+        else: conn.execute('DELETE FROM source_manifests')
+
+def _snapshot_source(path, job, retries):
+    started = time.time(); attempts = 0; ok = False; err = ''
+    scan = None
+    if get_setting('skip_unchanged', '1') == '1' and not job.cancelled:
+        try: scan = scan_source(path)
+        except Exception as e: print(f"Pre-scan Error ({path}): {e}", flush=True)
+        digest, snapshot_id = get_source_manifest(path); latest = latest_indexed_snapshot(path)
+        if scan and scan[0] == digest and latest and latest[0] == snapshot_id:
+            job.log(f"Sin cambios ({scan[1]} entradas), se omite el snapshot", path)
+            duration = time.time() - started
+            record_source_run(path, started, duration, 0, 0, True, 0, None, skipped=True)
+            return {'path': path, 'success': True, 'skipped': True, 'duration': duration, 'bytes': 0, 'files': 0, 'attempts': 0, 'error': None}
+    while attempts <= retries and not job.cancelled:
+        attempts += 1
+        with docker_control.quiesced(path, job.tagged(path)):
+            ok, _, err = run_kopia(['snapshot', 'create', path], job=job.tagged(path))
+        if ok: break
+    nbytes = files = 0
+    # Bytes nuevos escritos en el repo (los usa el planificador de mantenimiento)
+    with job.cond: uploaded = job.tag_progress.get(path, {}).get('uploaded_bytes', 0)
+    if ok:
+        sync_snapshot_index([path]); row = latest_indexed_snapshot(path)
+        if row: nbytes, files = row[1] or 0, row[2] or 0
+        # El digest tomado antes del snapshot: si algo cambio durante la copia, la proxima vez no coincidira
+        if scan and row: save_source_manifest(path, *scan, row[0])
+    duration = time.time() - started
+    # Un origen cortado por la cancelacion no cuenta como fallo
+    if ok or not job.cancelled: record_source_run(path, started, duration, nbytes, files, ok, attempts, None if ok else err, uploaded=uploaded)
+    return {'path': path, 'success': ok, 'skipped': False, 'duration': duration, 'bytes': nbytes, 'files': files, 'attempts': attempts, 'error': None if ok else err}
+
+def run_snapshots(paths, job, on_done=None):
+    parallel = max(1, int(get_setting('backup_parallel', '2') or 2)); retries = max(0, int(get_setting('backup_retries', '1') or 0))
+    durations = last_source_durations()
+    # Sin historial cuenta como el mas largo: un origen nuevo puede ser grande
+    ordered = sorted(paths, key=lambda p: durations.get(p, float('inf')), reverse=True)
+    with ThreadPoolExecutor(max_workers=min(parallel, len(ordered)), thread_name_prefix='snap') as pool:
+        def run(p):
+            r = _snapshot_source(p, job, retries)
+            if on_done and r['success'] and not r['skipped']: on_done(p)
+            return r
+        return list(pool.map(run, ordered))
+
+# --- MANTENIMIENTO ---
+# Tras cada backup basta el mantenimiento rapido; el completo (reescribe y compacta packs) solo cuando los datos sin
+# referenciar medidos por kopia o los dias desde el ultimo completo lo justifican. Nunca en la ruta de la peticion: se marca
+# como pendiente y maintenance_loop lo lanza dentro de la ventana de reposo, cuando no hay otros trabajos de kopia.
+_maint_event = threading.Event()
+MAINT_STATS_TTL = 86400
+_GC_RE = re.compile(r'GC found (\d+) (unused|in-use) contents \(([^)]+)\)')
+
+def in_quiet_window(window, now=None):
+    # "HH:MM-HH:MM" (puede cruzar la medianoche); vacio = cualquier hora
+    if not window: return True
+    start, _, end = (x.strip() for x in window.partition('-')); cur = (now or datetime.now(LOCAL_TZ)).strftime('%H:%M')
+    return start <= cur < end if start <= end else (cur >= start or cur < end)
+
+def maintenance_stats(measure=True):
+    # 'snapshot gc' sin --delete solo mide: contenidos que ningun snapshot usa y los que si, ambos en bytes empaquetados
+    # (comprimidos, lo que ocupan en el repositorio). Recorre todos los snapshots, asi que se mide como mucho una vez
+    # al dia (o de nuevo tras un completo) y el resultado queda en settings.
+    cfg = get_settings({'maint_last_full': '0', 'maint_stats': ''})
+    try: st = json.loads(cfg['maint_stats'] or '{}')
+    except ValueError: st = {}
+    if measure and time.time() - st.get('measured', 0) > MAINT_STATS_TTL:
+        # Sin --delete kopia sale con error justo cuando hay contenidos sin usar ("Not deleting because..."): vale
+        # cualquier codigo de salida si aparece la linea de contenidos en uso
+        _, out, err = run_kopia(['snapshot', 'gc'])
+        found = {kind: parse_size(size) for _, kind, size in _GC_RE.findall(out + '\n' + err)}
+        if 'in-use' in found: st = {'measured': time.time(), 'unreferenced': found.get('unused', 0), 'size': found['in-use'] + found.get('unused', 0)}
+        else:
+            # Fallo real: se anota la hora igualmente para no repetir el recorrido en cada planificacion
+            print(f"Maintenance Stats Error: {err[-300:]}", flush=True); st = {'measured': time.time()}
+        set_setting('maint_stats', json.dumps(st))
+    return {'last_full': float(cfg['maint_last_full']), 'measured': st.get('measured'), 'unreferenced': st.get('unreferenced'), 'size': st.get('size')}
+
+def plan_maintenance():
+    st = maintenance_stats(); cfg = get_settings({'maint_full_days': '7', 'maint_full_ratio': '20'})
+    if not st['last_full']: return True, "sin mantenimiento completo previo"
+    days = (time.time() - st['last_full']) / 86400
+    if days >= float(cfg['maint_full_days']): return True, f"{int(days)} dias desde el ultimo completo"
+    if st['size'] is None: return False, f"sin estadisticas del repositorio, ultimo completo hace {int(days)} dias"
+    if st['size'] and st['unreferenced'] * 100 >= st['size'] * float(cfg['maint_full_ratio']):
+        return True, f"{format_size(st['unreferenced'])} sin referenciar de {format_size(st['size'])}"
+    return False, f"{format_size(st['unreferenced'])} sin referenciar de {format_size(st['size'])}, ultimo completo hace {int(days)} dias"
+
+def request_maintenance():
+    set_setting('maint_pending', '1'); _maint_event.set()
+
+def maintenance_loop():
+    while True:
+        _maint_event.wait(300); _maint_event.clear()
+        try:
+            cfg = get_settings({'maint_pending': '0', 'maint_window': ''})
+            if cfg['maint_pending'] != '1' or not in_quiet_window(cfg['maint_window']): continue
+            if any(j.kind in ('backup', 'sync', 'restore', 'rescue') for j in active_jobs()): continue
+            submit_job('maintenance', do_maintenance, label='Mantenimiento')
+        except Exception as e: print(f"Maintenance Loop Error: {e}", flush=True)
+
+# --- SINCRONIZACION NUBE ---
+# Todas las subidas pasan por run_sync: paralelismo y limite de subida segun la hora salen de settings y cada
+# pasada queda en sync_runs con bytes, duracion y velocidad. Las cifras se leen de la salida de 'sync-to'.
+_SYNC_RE = {
+    'copy': re.compile(r'(\d+) \(([\d.]+ ?[KMGT]?i?B)\) to copy'),
+    'copied': re.compile(r'[Cc]opied (\d+) [Bb][Ll][Oo][Bb]s? \(([\d.]+ ?[KMGT]?i?B)\)'),
+    'delete': re.compile(r'(\d+) BLOBs to delete \(([\d.]+ ?[KMGT]?i?B)\)'),
+}
+
+class _SyncWatch(_TaggedJob):
+    # Vista del trabajo que ademas recoge los totales que imprime 'sync-to'
+    def __init__(self, job, tag='nube'): super().__init__(job, tag); self.stats = {}
+    def log(self, line):
+        for name, rx in _SYNC_RE.items():
+            m = rx.search(line)
+            if m: self.stats[f'{name}_blobs'] = int(m.group(1)); self.stats[f'{name}_bytes'] = parse_size(m.group(2))
+        super().log(line)
+
+def cloud_sync_args(cfg, parallel=1, upload_limit=0, dry_run=False):
+    cmd = ['repository', 'sync-to', 's3', '--delete', '--bucket', cfg['bucket'], '--access-key', cfg['access_key'], '--secret-access-key', cfg['secret_key']]
+    if cfg['endpoint']: cmd.extend(['--endpoint', cfg['endpoint']])
+    if cfg['region']: cmd.extend(['--region', cfg['region']])
+    if parallel > 1: cmd.append(f'--parallel={parallel}')
+    if upload_limit: cmd.append(f'--max-upload-speed={upload_limit}')
+    if dry_run: cmd.append('--dry-run')
+    return cmd
+
+def sync_upload_limit(schedule, now=None):
+    # Lineas "HH:MM-HH:MM=2MB" (bytes/s); la primera franja que contiene la hora manda, fuera de todas no hay limite
+    for rule in re.split(r'[\n;]+', schedule or ''):
+        window, _, limit = rule.partition('=')
+        if limit.strip() and in_quiet_window(window.replace(' ', ''), now): return parse_size(limit)
+    return 0
+
+def sync_options():
+    cfg = get_settings({'sync_parallel': '1', 'sync_rate_schedule': ''})
+    return max(1, int(cfg['sync_parallel'] or 1)), sync_upload_limit(cfg['sync_rate_schedule'])
+
+def estimate_sync(job, cfg):
+    watch = _SyncWatch(job); parallel, _ = sync_options()
+    ok, _, err = run_kopia(cloud_sync_args(cfg, parallel, dry_run=True), job=watch)
+    return ok, err, watch.stats
+
+def run_sync(job, cfg, estimate=True):
+    # El limite se fija al arrancar: kopia no lo cambia a mitad de pasada
+    parallel, limit = sync_options(); estimated = None
+    if estimate and not job.cancelled:
+        ok, _, stats = estimate_sync(job, cfg)
+        if ok:
+            estimated = stats.get('copy_bytes')
+            if estimated is not None: job.log(f"Estimacion: {format_size(estimated)} por subir, {format_size(stats.get('delete_bytes', 0))} por borrar", 'nube')
+    if limit: job.log(f"Limite de subida: {format_size(limit)}/s", 'nube')
+    watch = _SyncWatch(job); started = time.time()
+    ok, _, err = run_kopia(cloud_sync_args(cfg, parallel, limit), job=watch)
+    duration = time.time() - started
+    nbytes = watch.stats.get('copied_bytes', watch.stats.get('copy_bytes', 0)) if ok else watch.stats.get('copied_bytes', 0)
+    blobs = watch.stats.get('copied_blobs', watch.stats.get('copy_blobs', 0)) if ok else watch.stats.get('copied_blobs', 0)
+    if ok or not job.cancelled:
+        with db() as conn:
+            conn.execute('INSERT INTO sync_runs (started, duration, bytes, blobs, estimated, parallel, upload_limit, success, error) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                         (started, duration, nbytes, blobs, estimated, parallel, limit, 1 if ok else 0, None if ok else err))
+    if ok: observe('shieldpi_sync_duration_seconds', duration); inc('shieldpi_sync_bytes_total', nbytes)
+    if ok: job.log(f"Subidos {format_size(nbytes)} en {int(duration)}s ({format_size(int(nbytes / duration) if duration else 0)}/s)", 'nube')
+    return ok, err
+
+def last_sync_run():
+    with db() as conn: row = conn.execute('SELECT * FROM sync_runs ORDER BY started DESC LIMIT 1').fetchone()
+    if not row: return None
+    r = dict(row); r['throughput'] = int(r['bytes'] / r['duration']) if r['duration'] else 0
+    return r
+
+class SyncPipeline:
+    # Sube en cuanto termina cada origen, sin esperar al backup completo. Una pasada a la vez: los origenes que
+    # acaban mientras otra sube se juntan en la siguiente. close() espera a que no quede nada pendiente; hay que
+    # llamarlo siempre (tambien si el trabajo se cancela) para que el hilo termine. Con final_pass=False no fuerza la
+    # pasada minima: es el cierre cuando no se ha guardado ningun origen y no hay nada nuevo que subir.
+    def __init__(self, job, cfg):
+        self.job = job; self.cfg = cfg; self.pending = []; self.closed = False; self.final = True; self.passes = 0
+        self.ok = True; self.err = ''; self.cond = threading.Condition()
+        self.thread = threading.Thread(target=self._loop, daemon=True); self.thread.start()
+
+    def request(self, path):
+        with self.cond: self.pending.append(path); self.cond.notify()
+
+    def close(self, final_pass=True):
+        with self.cond: self.final = self.final and final_pass; self.closed = True; self.cond.notify()
+        self.thread.join()
+        return self.ok, self.err
+
+    def _loop(self):
+        while not self.job.cancelled:
+            with self.cond:
+                # Con timeout: cancelar el trabajo no avisa a esta condicion
+                while not self.pending and not self.closed and not self.job.cancelled: self.cond.wait(1)
+                batch, self.pending = self.pending, []
+            # Al cerrar sin nada nuevo basta con haber hecho al menos una pasada (ninguna si se cierra sin pasada final)
+            if not batch and (self.passes or not self.final): return
+            if batch: self.job.log(f"Subiendo {', '.join(batch)}", 'nube')
+            # Cada pasada sube todo lo pendiente del repositorio: cuenta el resultado de la ultima
+            if self.job.cancelled: return
+            self.ok, self.err = run_sync(self.job, self.cfg, estimate=False); self.passes += 1
+
+# --- EXPOSICION DE METRICAS ---
+def metric_gauges():
+    # [(nombre, etiquetas, valor)] leidos de la base de datos en cada consulta: sobreviven a reinicios
+    now = time.time(); out = []
+    with db() as conn:
+        rows = conn.execute('SELECT source, duration, bytes, files, success, started FROM source_runs r WHERE skipped = 0 AND started = (SELECT max(started) FROM source_runs WHERE source = r.source AND skipped = 0)').fetchall()
+        last_ok = conn.execute('SELECT max(started + duration) FROM source_runs WHERE success = 1').fetchone()[0]
+        if last_ok is None: last_ok = conn.execute('SELECT max(start_ts) FROM snapshots').fetchone()[0]
+        snapshots = conn.execute('SELECT count(*) FROM snapshots').fetchone()[0]
+    for r in rows:
+        out += [('shieldpi_source_last_duration_seconds', {'source': r[0]}, r[1] or 0), ('shieldpi_source_last_size_bytes', {'source': r[0]}, r[2] or 0),
+                ('shieldpi_source_last_files', {'source': r[0]}, r[3] or 0), ('shieldpi_source_last_success', {'source': r[0]}, r[4])]
+    if last_ok: out.append(('shieldpi_last_backup_age_seconds', {}, int(now - last_ok)))
+    sync = last_sync_run()
+    if sync:
+        out += [('shieldpi_sync_last_bytes', {}, sync['bytes'] or 0), ('shieldpi_sync_last_duration_seconds', {}, round(sync['duration'] or 0, 3)),
+                ('shieldpi_sync_last_throughput_bytes_per_second', {}, sync['throughput']), ('shieldpi_sync_last_success', {}, sync['success'])]
+    out += [('shieldpi_snapshots_indexed', {}, snapshots), ('shieldpi_jobs_active', {}, len(active_jobs()))]
+    return out
+
+def _metric_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs: return ''
+    esc = lambda v: str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{k}="{esc(v)}"' for k, v in pairs) + '}'
+
+def render_metrics():
+    lines = []; typed = set()
+    def declare(name, kind):
+        if name not in typed: typed.add(name); lines.append(f'# TYPE {name} {kind}')
+    with _metrics_lock: hists = {k: dict(v, buckets=list(v['buckets'])) for k, v in _histograms.items()}; counters = dict(_counters)
+    for (name, labels), h in sorted(hists.items()):
+        declare(name, 'histogram'); acc = 0
+        for le, n in zip(METRIC_BUCKETS, h['buckets']):
+            acc += n; lines.append(f'{name}_bucket{_metric_labels(labels, [("le", le)])} {acc}')
+        lines.append(f'{name}_bucket{_metric_labels(labels, [("le", "+Inf")])} {h["count"]}')
+        lines.append(f'{name}_sum{_metric_labels(labels)} {h["sum"]:.6f}'); lines.append(f'{name}_count{_metric_labels(labels)} {h["count"]}')
+    for (name, labels), v in sorted(counters.items()):
+        declare(name, 'counter'); lines.append(f'{name}{_metric_labels(labels)} {v}')
+    # Cada familia debe salir junta: se ordena por nombre conservando el orden de las etiquetas
+    for name, labels, v in sorted(metric_gauges(), key=lambda g: g[0]):
+        declare(name, 'gauge'); lines.append(f'{name}{_metric_labels(labels.items())} {v}')
+    return '\n'.join(lines) + '\n'
+
+def _percentile(h, q):
+    target = h['count'] * q; acc = 0
+    for le, n in zip(METRIC_BUCKETS, h['buckets']):
+        acc += n
+        if acc >= target: return min(le, h['max'])
+    return h['max']
+
+def metrics_summary():
+    # Resumen para el dashboard: llamadas mas lentas primero y origenes ordenados por duracion
+    with _metrics_lock: hists = {k: dict(v, buckets=list(v['buckets'])) for k, v in _histograms.items()}
+    commands = [{'tool': dict(l)['tool'], 'command': dict(l)['command'], 'count': h['count'], 'avg': round(h['sum'] / h['count'], 3),
+                 'p95': round(_percentile(h, 0.95), 3), 'max': round(h['max'], 3)} for (name, l), h in hists.items() if name == 'shieldpi_command_duration_seconds' and h['count']]
+    gauges = metric_gauges(); sources = {}
+    for name, labels, v in gauges:
+        if 'source' in labels: sources.setdefault(labels['source'], {'source': labels['source']})[name.replace('shieldpi_source_last_', '')] = v
+    single = {name.replace('shieldpi_', ''): v for name, labels, v in gauges if not labels}
+    lag = next((h for (name, _), h in hists.items() if name == 'shieldpi_scheduler_lag_seconds'), None)
+    return {'commands': sorted(commands, key=lambda c: c['avg'] * c['count'], reverse=True),
+            'sources': sorted(sources.values(), key=lambda x: x.get('duration_seconds', 0), reverse=True),
+            'last_backup_age': single.get('last_backup_age_seconds'), 'sync': {k[10:]: v for k, v in single.items() if k.startswith('sync_last_')},
+            'scheduler_lag_max': round(lag['max'], 3) if lag else None, 'jobs_active': single.get('jobs_active', 0)}
+
+# --- TAREAS (se ejecutan en el pool de trabajos) ---
+def do_backup(job, scheduled=False, paths=None):
+    paths = paths or [x['path'] for x in get_policies()]
+    if not paths: return False, "Sin carpetas configuradas."
+    cloud_cfg = get_cloud_config()
+    pipeline = SyncPipeline(job, cloud_cfg) if cloud_cfg and get_setting('sync_per_source', '0') == '1' else None
+    try: return _backup_and_sync(job, scheduled, paths, cloud_cfg, pipeline)
+    finally:
+        # Si ya se cerro con exito esto no hace nada; si no (excepcion, cancelacion), solo sube lo ya pedido
+        if pipeline: pipeline.close(final_pass=False)
+
+def _backup_and_sync(job, scheduled, paths, cloud_cfg, pipeline):
+    today_str = datetime.now(LOCAL_TZ).strftime('%Y-%m-%d')
+    results = run_snapshots(paths, job, pipeline.request if pipeline else None)
+    failed = [r for r in results if not r['success']]
+    if len(failed) == len(results):
+        err = failed[0]['error'] if failed else ''
+        if not job.cancelled: send_notification(f"Fallo Backup Local: {err}" if scheduled else f"Fallo Backup: {err}", is_success=False)
+        if pipeline: pipeline.close(final_pass=False)
+        return False, f"Error: {err}"
+    if scheduled: set_setting('last_run_date', today_str)
+    mark_backup_done()
+    msg = "Backup Local Exitoso."
+    if failed:
+        # Backup parcial: se sigue con mantenimiento y nube para lo que si se guardo
+        names = ', '.join(r['path'] for r in failed)
+        msg = f"Backup Local Parcial ({len(results) - len(failed)}/{len(results)}). Fallaron: {names}."
+        if not job.cancelled: send_notification(f"Fallo Backup en: {names}", is_success=False)
+    skipped = sum(1 for r in results if r.get('skipped'))
+    if skipped: msg += f" ({skipped} sin cambios)"
+
+    # El mantenimiento queda pendiente para la ventana de reposo; la nube sube lo que hay ahora
+    request_maintenance()
+
+    if cloud_cfg and not job.cancelled:
+        print("--- Auto Sync Nube ---" if scheduled else "--- Auto Sync tras Backup Manual ---", flush=True)
+        s_sync, err_sync = pipeline.close() if pipeline else run_sync(job, cloud_cfg)
+        if s_sync:
+            msg += " Y Sincronizacion a Nube Completada."
+            send_notification("Ciclo Diario Completado: Backup Local OK + Sync Nube OK" if scheduled else "Backup Manual + Sync Nube Exitoso")
+        else:
+            msg += f" Pero fallo la Nube: {err_sync}"
+            print(f"Error Sync: {err_sync}", flush=True)
+            send_notification("Ciclo Diario Completado: Backup Local OK + Error Nube" if scheduled else f"Sync Nube fallo: {err_sync}", is_success=scheduled)
+    elif not job.cancelled: send_notification("Ciclo Diario Completado: Backup Local OK" if scheduled else "Backup Manual Local Exitoso")
+    return True, msg
+
+def do_sync(job):
+    cfg = get_cloud_config()
+    if not cfg: return False, "Configura la nube primero."
+    # Sincronizacion manual con borrado espejo
+    success, err = run_sync(job, cfg)
+    if success: send_notification("Sync Nube Manual OK."); return True, "Sincronizacion OK."
+    print(f"Sync Error: {err}", flush=True)
+    if not job.cancelled: send_notification(f"Sync Error: {err}", False)
+    return False, f"Error: {err}"
+
+def do_sync_estimate(job):
+    cfg = get_cloud_config()
+    if not cfg: return False, "Configura la nube primero."
+    ok, err, stats = estimate_sync(job, cfg)
+    if not ok: return False, f"Error: {err}"
+    return True, f"Por subir: {format_size(stats.get('copy_bytes', 0))} ({stats.get('copy_blobs', 0)} blobs). Por borrar: {format_size(stats.get('delete_bytes', 0))}."
+
+def do_restore(job, sid, p, rel='', stop=True):
+    # rel: solo esa carpeta o archivo del snapshot, restaurado en su sitio dentro del origen
+    if rel:
+        _, root = snapshot_root(sid)
+        if not root or not snapshot_entry(sid, rel): return False, "La ruta no existe en el snapshot."
+        sid, p = f'{root}/{rel}', os.path.join(p, rel)
+        os.makedirs(os.path.dirname(p), exist_ok=True)
+    with docker_control.stopped(p, job) if stop else nullcontext(): s, e = kopia_backend.restore(sid, p, job)
+    return s, "Restaurado." if s else f"Error: {e}"
+
+def do_maintenance(job, full=None):
+    reason = "forzado"
+    if full is None: full, reason = plan_maintenance()
+    job.log(f"Mantenimiento {'completo' if full else 'rapido'}: {reason}")
+    s, _, e = run_kopia(['maintenance', 'run'] + (['--full'] if full else []), job=job)
+    if s:
+        set_setting('maint_pending', '0')
+        # Tras un completo las medidas anteriores ya no valen: la proxima planificacion vuelve a medir
+        if full: set_setting('maint_last_full', str(time.time())); set_setting('maint_stats', '')
+    request_repo_refresh()
+    return s, f"Mantenimiento {'completo' if full else 'rapido'} completado." if s else f"Error: {e}"
+
+# Rescate: cada origen se restaura en paralelo y su estado queda en rescue_sources, asi un rescate
+# interrumpido (cancelado, reinicio del contenedor) se relanza y solo repite lo que falta.
+def rescue_checkpoint():
+    with db() as conn: return [dict(r) for r in conn.execute('SELECT * FROM rescue_sources ORDER BY priority, path').fetchall()]
+
+def rescue_pending(): return any(r['status'] != 'done' for r in rescue_checkpoint())
+
+def clear_rescue_checkpoint():
+    with db() as conn: conn.execute('DELETE FROM rescue_sources')
+
+def rescue_priority(path, patterns):
+    # Posicion del primer patron que aparece en la ruta (ej: "mysql" antes que "media"); sin coincidencia va al final
+    for i, pat in enumerate(patterns):
+        if pat in path.lower(): return i
+    return len(patterns)
+
+def set_rescue_source(path, **fields):
+    cols = ', '.join(f'{k} = ?' for k in fields)
+    with db() as conn: conn.execute(f'UPDATE rescue_sources SET {cols} WHERE path = ?', (*fields.values(), path))
+
+def _rescue_source(job, row, env):
+    path = row['path']; started = time.time()
+    set_rescue_source(path, status='running', started=started, bytes=0, error=None)
+    job.log(f"Restaurando desde {row['snapshot_id'][:8]} ({format_size(row['total_bytes'] or 0)})", path)
+    # Restauramos DIRECTAMENTE a la ruta original
+    ok, _, err = run_kopia(['snapshot', 'restore', row['snapshot_id'], path], env, job.tagged(path))
+    duration = time.time() - started
+    if ok:
+        total = row['total_bytes'] or 0
+        set_rescue_source(path, status='done', bytes=total, finished=time.time())
+        job.log(f"Restaurado en {int(duration)}s ({format_size(int(total / duration) if duration else 0)}/s)", path)
+    elif job.cancelled: set_rescue_source(path, status='pending')
+    else:
+        print(f"Error restaurando {path}: {err}", flush=True)
+        set_rescue_source(path, status='error', finished=time.time(), error=err)
+    return ok
+
+def rescue_status(job=None):
+    # Checkpoint + progreso en vivo del trabajo: bytes, velocidad y tiempo restante por origen
+    live = {}
+    if job:
+        with job.cond: live = {t: dict(p) for t, p in job.tag_progress.items() if t}
+    now = time.time(); rows = rescue_checkpoint()
+    for r in rows:
+        r['throughput'] = r['eta'] = None
+        if r['status'] == 'running':
+            p = live.get(r['path'], {}); r['bytes'] = p.get('processed_bytes', 0) or p.get('hashed_bytes', 0)
+            elapsed = now - (r['started'] or now)
+            if r['bytes'] and elapsed > 0:
+                r['throughput'] = int(r['bytes'] / elapsed)
+                if r['total_bytes']: r['eta'] = int(max(0, r['total_bytes'] - r['bytes']) / r['throughput'])
+        elif r['status'] == 'done' and r['started'] and r['finished'] and r['finished'] > r['started']:
+            r['throughput'] = int((r['total_bytes'] or 0) / (r['finished'] - r['started']))
+    return rows
+
+def do_apply_retention(job):
+    # Aplica la nueva retencion a todos los origenes; la limpieza de datos queda para el planificador
+    s, _, e = run_kopia(['snapshot', 'expire', '--all', '--delete'], job=job)
+    sync_snapshot_index(); request_maintenance(); request_repo_refresh()
+    return s, "Retencion aplicada." if s else f"Error: {e}"
+
+def do_rescue(job, form):
+    # Nota: local_path en el form se ignora para la restauracion de archivos, 
+    # pero lo usamos para saber donde poner el Repo Local (Database).
+    repo_location = form.get('local_path'); 
+    pwd = form.get('repo_password')
+    bucket = form.get('bucket'); access = form.get('access_key'); secret = form.get('secret_key')
+    endpoint = form.get('endpoint'); region = form.get('region'); env = {'KOPIA_PASSWORD': pwd}
+    parallel = max(1, int(form.get('parallel') or get_setting('rescue_parallel', '2') or 2))
+    patterns = [x.strip().lower() for x in re.split(r'[,\n]', form.get('priority') or '') if x.strip()]
+    set_setting('rescue_parallel', str(parallel)); set_setting('rescue_priority', ', '.join(patterns))
+    
+    print("--- INICIANDO RESCATE v2.9 (IN-PLACE, PARALELO) ---", flush=True)
+
+    # 1. Conectar a Nube
+    kopia_backend.reset()
+    s, _, e = run_kopia(['repository', 'connect', 's3', '--bucket', bucket, '--access-key', access, '--secret-access-key', secret, '--endpoint', endpoint, '--region', region], env)
+    if not s: return False, f"Error Nube: {e}"
+
+    # 2. Obtener Snapshots (el mas reciente de cada ruta original)
+    s, out, e = run_kopia(['snapshot', 'list', '--json', '--all'], env)
+    if not s: return False, f"Error listando snapshots: {e}"
+    try: snaps = json.loads(out)
+    except Exception as ex: return False, f"Error procesando snapshots: {ex}"
+    snaps.sort(key=lambda x: x.get('startTime', ''), reverse=True)
+    unique_sources = {}
+    for snap in snaps:
+        src_path = snap.get('source', {}).get('path', '')
+        if src_path and src_path not in unique_sources: unique_sources[src_path] = snap
+    if not unique_sources: return False, "No se encontraron snapshots validos."
+
+    # 3. Checkpoint: lo ya restaurado desde el mismo snapshot del mismo bucket no se repite
+    done = {r['path'] for r in rescue_checkpoint() if r['status'] == 'done' and r['bucket'] == bucket and unique_sources.get(r['path'], {}).get('id') == r['snapshot_id']}
+    # Prioridad del usuario y, a igualdad, el mas grande primero para que no quede solo al final
+    ordered = sorted(unique_sources, key=lambda p: (rescue_priority(p, patterns), -(unique_sources[p].get('stats') or {}).get('totalSize', 0), p))
+    with db() as conn:
+        conn.execute('DELETE FROM rescue_sources WHERE path NOT IN (%s)' % ','.join('?' * len(done)), tuple(done))
+        for i, p in enumerate(ordered):
+            if p in done: conn.execute('UPDATE rescue_sources SET priority = ? WHERE path = ?', (i, p))
+            else: conn.execute("INSERT INTO rescue_sources (path, bucket, snapshot_id, priority, status, total_bytes, bytes) VALUES (?, ?, ?, ?, 'pending', ?, 0)",
+                               (p, bucket, unique_sources[p]['id'], i, (unique_sources[p].get('stats') or {}).get('totalSize', 0)))
+    if done: job.log(f"Reanudando rescate: {len(done)}/{len(ordered)} rutas ya restauradas")
+
+    # 4. RESTAURACION EN SITIO (In-Place), varias rutas a la vez en orden de prioridad
+    pending = [r for r in rescue_checkpoint() if r['status'] != 'done']
+    if pending:
+        with ThreadPoolExecutor(max_workers=min(parallel, len(pending)), thread_name_prefix='rescue') as pool:
+            list(pool.map(lambda r: not job.cancelled and _rescue_source(job, r, env), pending))
+
+    rows = rescue_checkpoint(); restored_count = sum(1 for r in rows if r['status'] == 'done')
+    failed = [r['path'] for r in rows if r['status'] == 'error']
+    if job.cancelled: return False, f"Rescate cancelado tras restaurar {restored_count}/{len(rows)} rutas. Vuelve a lanzarlo para continuar."
+    if failed and not form.get('allow_partial'): return False, f"Fallaron {len(failed)} rutas: {', '.join(failed)}. Vuelve a lanzar el rescate para reintentarlas."
+    if restored_count > 0:
+        # 5. Reconfiguracion Local (Database)
+        if os.path.exists(KOPIA_CONFIG): os.remove(KOPIA_CONFIG)
+        
+        # Usamos la ruta que puso el usuario SOLO para guardar la DB de Kopia, no los archivos.
+        # Si el usuario puso /host/backups, ahi vivira la DB.
+        repo_storage = repo_location
+        if os.path.exists(repo_storage): shutil.rmtree(repo_storage, ignore_errors=True)
+        if not os.path.exists(repo_storage): os.makedirs(repo_storage, exist_ok=True)
+        
+        s, _, e = run_kopia(['repository', 'create', 'filesystem', '--path', repo_storage], env)
+        
+        if s:
+            set_cloud_config('s3', bucket, access, secret, endpoint, region)
+            clear_rescue_checkpoint()
+            kopia_backend.reset(); clear_snapshot_index(); refresh_repo_state()
+            msg = f"Rescate Exitoso! Se restauraron {restored_count} rutas en su ubicacion original."
+            return True, msg + (f" Fallaron: {', '.join(failed)}." if failed else "")
+        else:
+            return False, f"Datos restaurados, pero fallo config local: {e}"
+    else:
+        return False, "No se pudo restaurar ninguna ruta."
+
+def rescue_in_progress(): return any(j.kind == 'rescue' for j in active_jobs())
+
+# --- EXPLORADOR DE ARCHIVOS ---
+# El listado ordenado de cada carpeta se guarda (LRU) junto al mtime de la carpeta, asi paginar no vuelve a leerla.
+# Los tamanos recursivos de subcarpetas se calculan en un hilo aparte y se sirven desde cache (LRU) cuando estan listos.
+# El recorrido no cruza a otro sistema de archivos, y los puntos de montaje y los sistemas virtuales o de red no se miden.
+_listing_cache = OrderedDict()
+_listing_lock = threading.Lock()
+_dir_sizes = OrderedDict()
+_dir_size_lock = threading.Lock()
+_dir_size_queue = queue.Queue()
+_dir_size_pending = set()
+_mounts = {'read': 0, 'types': {}}
+
+def list_directory(path):
+    # (entradas ordenadas [(tipo, nombre)], {nombre: (tamano, mtime, st_dev)}) del mismo recorrido con scandir
+    mtime = os.stat(path).st_mtime_ns
+    with _listing_lock:
+        hit = _listing_cache.get(path)
+        if hit and hit[0] == mtime: _listing_cache.move_to_end(path); return hit[1], hit[2]
+    entries = []; stats = {}
+    with os.scandir(path) as it:
+        for e in it:
+            entries.append((0 if e.is_dir() else 1, e.name))
+            try: st = e.stat(follow_symlinks=False); stats[e.name] = (st.st_size, st.st_mtime, st.st_dev)
+            except OSError: pass
+    entries.sort()
+    with _listing_lock:
+        _listing_cache[path] = (mtime, entries, stats)
+        while len(_listing_cache) > 32: _listing_cache.popitem(last=False)
+    return entries, stats
+
+def mount_type(path):
+    # Tipo del montaje que contiene la ruta (el punto de montaje mas largo que la prefija); la tabla se relee cada minuto
+    if time.time() - _mounts['read'] > 60:
+        types = {}
+        try:
+            with open('/proc/self/mounts') as f:
+                for line in f:
+                    parts = line.split()
+                    if len(parts) > 2: types[re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), parts[1])] = parts[2]
+        except OSError: pass
+        _mounts.update(read=time.time(), types=types)
+    types = _mounts['types']
+    while True:
+        if path in types: return types[path]
+        if path == '/': return None
+        path = os.path.dirname(path)
+
+def dir_sizable(path):
+    try: return mount_type(path) not in NO_SIZE_FS and os.stat(path).st_dev == os.stat(os.path.dirname(path)).st_dev
+    except OSError: return False
+
+def dir_size(path):
+    total = 0; stack = [path]; dev = os.stat(path).st_dev
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                for e in it:
+                    try:
+                        st = e.stat(follow_symlinks=False)
+                        if e.is_dir(follow_symlinks=False):
+                            if st.st_dev == dev: stack.append(e.path)
+                        else: total += st.st_size
+                    except OSError: pass
+        except OSError: pass
+    return total
+
+def cached_dir_size(path, sizable=None):
+    # sizable: ya comprobado por quien llama (el explorador lo sabe por el listado)
+    if not (dir_sizable(path) if sizable is None else sizable): return None
+    with _dir_size_lock:
+        hit = _dir_sizes.get(path)
+        if hit: _dir_sizes.move_to_end(path)
+        if hit and time.time() - hit[1] < DIR_SIZE_TTL: return hit[0]
+        if path not in _dir_size_pending:
+            _dir_size_pending.add(path); _dir_size_queue.put(path)
+    return hit[0] if hit else None
+
+def dir_size_loop():
+    while True:
+        path = _dir_size_queue.get()
+        try:
+            size = dir_size(path)
+            with _dir_size_lock:
+                _dir_sizes[path] = (size, time.time()); _dir_sizes.move_to_end(path)
+                while len(_dir_sizes) > DIR_SIZE_ENTRIES: _dir_sizes.popitem(last=False)
+        except Exception as e: print(f"Dir Size Error ({path}): {e}", flush=True)
+        finally:
+            with _dir_size_lock: _dir_size_pending.discard(path)
+
+def browse_path(path):
+    path = os.path.normpath(path or HOST_ROOT)
+    return path if path == HOST_ROOT or path.startswith(HOST_ROOT + '/') else HOST_ROOT
+
+# --- EXPLORADOR DE SNAPSHOTS ---
+# Un snapshot se recorre nivel a nivel con el manifiesto de cada carpeta ('kopia show <objeto>'). Los objetos de kopia
+# son inmutables (el ID es el hash del contenido), asi que los listados se guardan en un LRU sin caducidad.
+_snap_listing_cache = OrderedDict()
+_snap_listing_lock = threading.Lock()
+
+def snapshot_relpath(rel):
+    parts = [x for x in (rel or '').split('/') if x and x != '.']
+    if '..' in parts: raise ValueError('Ruta no valida')
+    return '/'.join(parts)
+
+def snapshot_root(sid):
+    with db() as conn: row = conn.execute('SELECT source, root_oid FROM snapshots WHERE id = ?', (sid,)).fetchone()
+    return (row[0], row[1]) if row and row[1] else (None, None)
+
+def list_snapshot_dir(oid):
+    with _snap_listing_lock:
+        hit = _snap_listing_cache.get(oid)
+        if hit is not None: _snap_listing_cache.move_to_end(oid); return hit
+    raw = kopia_backend.show_directory(oid)
+    if raw is None: return None
+    entries = []
+    for e in raw:
+        kind = {'d': 'dir', 's': 'link'}.get(e.get('type'), 'file'); summ = e.get('summ') or {}
+        entries.append((0 if kind == 'dir' else 1, e.get('name', ''), {'type': kind, 'obj': e.get('obj', ''), 'mtime': e.get('mtime'),
+                                                                        'size': summ.get('size', 0) if kind == 'dir' else e.get('size', 0), 'files': summ.get('files')}))
+    entries.sort(key=lambda x: x[:2])
+    with _snap_listing_lock:
+        _snap_listing_cache[oid] = entries
+        while len(_snap_listing_cache) > 64: _snap_listing_cache.popitem(last=False)
+    return entries
+
+def snapshot_entry(sid, rel):
+    # Baja desde la raiz por los listados en cache; None si algun tramo no existe
+    _, root = snapshot_root(sid)
+    if not root: return None
+    entry = {'type': 'dir', 'obj': root, 'size': None}
+    for name in filter(None, rel.split('/')):
+        entries = list_snapshot_dir(entry['obj']) if entry['type'] == 'dir' else None
+        entry = next((e[2] for e in entries or [] if e[1] == name), None)
+        if entry is None: return None
+    return entry
 
 # --- AUTH ---
-def user_exists(): conn = sqlite3.connect(DB_PATH); c = conn.cursor(); c.execute('SELECT count(*) FROM users'); count = c.fetchone()[0]; conn.close(); return count > 0
+# Una vez creado el usuario no se borra: basta con consultarlo hasta que exista
+_users_exist = False
+def user_exists():
+    global _users_exist
+    if not _users_exist:
+        with db() as conn: _users_exist = conn.execute('SELECT 1 FROM users LIMIT 1').fetchone() is not None
+    return _users_exist
 def create_user(u, p): 
-    try: conn = sqlite3.connect(DB_PATH); c = conn.cursor(); c.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)', (u, generate_password_hash(p))); conn.commit(); conn.close(); return True
+    try:
+        with db() as conn: conn.execute('INSERT INTO users (username, password_hash) VALUES (?, ?)', (u, generate_password_hash(p)))
+        return True
     except: return False
-def verify_user(u, p): conn = sqlite3.connect(DB_PATH); c = conn.cursor(); c.execute('SELECT password_hash FROM users WHERE username = ?', (u,)); row = c.fetchone(); conn.close(); return True if row and check_password_hash(row[0], p) else False
+def verify_user(u, p):
+    with db() as conn: row = conn.execute('SELECT password_hash FROM users WHERE username = ?', (u,)).fetchone()
+    return True if row and check_password_hash(row[0], p) else False
 
-if not os.path.exists('/app/config'): os.makedirs('/app/config')
+if not os.path.exists(CONFIG_DIR): os.makedirs(CONFIG_DIR)
 init_db()
 sched_thread = threading.Thread(target=scheduler_loop, daemon=True); sched_thread.start()
+state_thread = threading.Thread(target=repo_state_loop, daemon=True); state_thread.start()
+size_thread = threading.Thread(target=dir_size_loop, daemon=True); size_thread.start()
+maint_thread = threading.Thread(target=maintenance_loop, daemon=True); maint_thread.start()
+notify_thread = threading.Thread(target=notification_loop, daemon=True); notify_thread.start()
 
 # --- RUTAS ---
 @app.before_request
 def check_auth():
     if request.endpoint in ['static', 'setup', 'login']: return
+    # Prometheus no inicia sesion: /metrics acepta el token de SHIELDPI_METRICS_TOKEN
+    if request.endpoint == 'metrics' and METRICS_TOKEN and secrets.compare_digest(request.headers.get('Authorization', ''), f'Bearer {METRICS_TOKEN}'): return
     if not user_exists(): return redirect(url_for('setup'))
     if 'user' not in session and request.endpoint != 'login': return redirect(url_for('login'))
 
 @app.route('/')
 def home():
-    is_connected, repo_path = get_repo_status()
-    if not is_connected: return redirect(url_for('repo_setup'))
+    # Un rescate a medias no bloquea el panel: se avisa y se puede continuar o descartar desde el propio panel
+    if rescue_in_progress(): return redirect(url_for('repo_setup'))
+    state = get_repo_state()
+    if not state['connected']: return redirect(url_for('repo_setup'))
     server_time = datetime.now(LOCAL_TZ).strftime('%I:%M %p')
-    return render_template('dashboard.html', user=session['user'], hostname=socket.gethostname(), repo_path=repo_path, sources=get_policies(), last_backup=get_last_snapshot_time(), schedule={'frequency': get_setting('freq', 'manual'), 'time': get_setting('time', '03:00')}, retention=int(get_setting('retention', '5')), server_time=server_time, notify_cfg={'provider': get_setting('notify_provider', 'none'), 'token': get_setting('notify_token', ''), 'chatid': get_setting('notify_chatid', ''), 'url': get_setting('notify_url', '')}, cloud_cfg=get_cloud_config())
+    cfg = get_settings({'freq': 'manual', 'time': '03:00', 'cron': '', 'backup_parallel': '2', 'retention': '5', 'maint_window': '', 'maint_full_days': '7', 'maint_full_ratio': '20', 'maint_last_full': '0', 'sync_parallel': '1', 'sync_rate_schedule': '', 'sync_per_source': '0', 'notify_provider': 'none', 'notify_token': '', 'notify_chatid': '', 'notify_url': ''})
+    return render_template('dashboard.html', user=session['user'], hostname=socket.gethostname(), repo_path=state['repo_path'], sources=state['sources'], last_backup=state['last_backup'], schedule={'frequency': cfg['freq'], 'time': cfg['time'], 'cron': cfg['cron'], 'parallel': int(cfg['backup_parallel']), 'next': format_timestamp(next_scheduled_run())}, retention=int(cfg['retention']), maintenance={'window': cfg['maint_window'], 'full_days': cfg['maint_full_days'], 'full_ratio': cfg['maint_full_ratio'], 'last_full': format_timestamp(float(cfg['maint_last_full']) or None), 'stats': maintenance_stats(measure=False)}, server_time=server_time, notify_cfg={'provider': cfg['notify_provider'], 'token': cfg['notify_token'], 'chatid': cfg['notify_chatid'], 'url': cfg['notify_url']}, cloud_cfg=get_cloud_config(), sync_cfg={'parallel': cfg['sync_parallel'], 'rate_schedule': cfg['sync_rate_schedule'], 'per_source': cfg['sync_per_source'] == '1', 'last': last_sync_run()}, rescue_pending=rescue_pending())
 
 @app.route('/settings/notifications', methods=['POST'])
-def settings_notifications(): set_setting('notify_provider', request.form.get('notify_provider')); set_setting('notify_token', request.form.get('telegram_token')); set_setting('notify_chatid', request.form.get('telegram_chatid')); set_setting('notify_url', request.form.get('webhook_url')); flash("Notificaciones guardadas."); return redirect(url_for('home'))
+def settings_notifications(): set_setting('notify_provider', ','.join(request.form.getlist('notify_provider')) or 'none'); set_setting('notify_token', request.form.get('telegram_token')); set_setting('notify_chatid', request.form.get('telegram_chatid')); set_setting('notify_url', request.form.get('webhook_url')); flash("Notificaciones guardadas."); return redirect(url_for('home'))
 @app.route('/settings/cloud', methods=['POST'])
 def settings_cloud(): set_cloud_config('s3', request.form.get('bucket'), request.form.get('access_key'), request.form.get('secret_key'), request.form.get('endpoint'), request.form.get('region')); flash("Nube guardada."); return redirect(url_for('home'))
 
+@app.route('/settings/sync', methods=['POST'])
+def settings_sync():
+    schedule = '\n'.join(x.strip() for x in (request.form.get('rate_schedule') or '').splitlines() if x.strip())
+    for rule in schedule.splitlines():
+        window, _, limit = rule.partition('=')
+        if not re.fullmatch(r'([01]\d|2[0-3]):[0-5]\d-([01]\d|2[0-3]):[0-5]\d', window.replace(' ', '')) or not parse_size(limit):
+            flash(f"Franja invalida: {rule} (formato HH:MM-HH:MM=2MB)"); return redirect(url_for('home'))
+    set_setting('sync_rate_schedule', schedule)
+    set_setting('sync_parallel', str(max(1, min(32, int(request.form.get('parallel') or 1)))))
+    set_setting('sync_per_source', '1' if request.form.get('per_source') else '0')
+    flash("Sincronizacion guardada."); return redirect(url_for('home'))
+
+@app.route('/api/sync/estimate', methods=['POST'])
+def sync_estimate():
+    if not get_cloud_config(): flash("Configura la nube primero."); return redirect(url_for('home'))
+    return job_response(submit_job('sync', do_sync_estimate, label='Estimar Sync', key='sync_estimate'), 'home')
+
 @app.route('/api/sync/run', methods=['POST'])
 def sync_run():
-    cfg = get_cloud_config()
-    if not cfg: flash("Configura la nube primero."); return redirect(url_for('home'))
-    # Sincronizacion manual con borrado espejo
-    cmd = ['repository', 'sync-to', 's3', '--delete', '--bucket', cfg['bucket'], '--access-key', cfg['access_key'], '--secret-access-key', cfg['secret_key']]
-    if cfg['endpoint']: cmd.extend(['--endpoint', cfg['endpoint']])
-    if cfg['region']: cmd.extend(['--region', cfg['region']])
-    success, _, err = run_kopia(cmd)
-    if success: send_notification("Sync Nube Manual OK."); flash("Sincronizacion OK.")
-    else: print(f"Sync Error: {err}", flush=True); send_notification(f"Sync Error: {err}", False); flash(f"Error: {err}")
-    return redirect(url_for('home'))
+    if not get_cloud_config(): flash("Configura la nube primero."); return redirect(url_for('home'))
+    return job_response(submit_job('sync', do_sync, label='Sync Nube'), 'home')
 
 @app.route('/api/test_notification')
-def test_notification(): return "OK" if send_notification("Test ShieldPi") else "Error"
+def test_notification():
+    # Sin cola ni reintentos: el usuario espera el resultado de cada proveedor
+    if not notification_requests("Test ShieldPi"): return "Sin proveedores configurados"
+    return "OK" if deliver_notification("ShieldPi: Test ShieldPi", retries=0) else "Error"
 
 # --- MODIFICACION: CORRECCION DE RETENCION ---
 @app.route('/settings/retention', methods=['POST'])
@@ -267,93 +1834,214 @@ def settings_retention():
     # 2. Guardar en base de datos local
     set_setting('retention', v)
     
-    # 3. Forzar mantenimiento inmediato para limpiar archivos viejos
-    run_kopia(['maintenance', 'run', '--full'])
-    
-    return redirect(url_for('home'))
+    # 3. Borrar los snapshots que sobran ya; el mantenimiento se planifica en la ventana de reposo
+    return job_response(submit_job('retention', do_apply_retention, label='Retencion'), 'home')
+
+@app.route('/settings/maintenance', methods=['POST'])
+def settings_maintenance():
+    window = (request.form.get('window') or '').strip()
+    if window and not re.fullmatch(r'([01]\d|2[0-3]):[0-5]\d-([01]\d|2[0-3]):[0-5]\d', window.replace(' ', '')):
+        flash("Ventana invalida (formato HH:MM-HH:MM)."); return redirect(url_for('home'))
+    set_setting('maint_window', window.replace(' ', ''))
+    set_setting('maint_full_days', str(max(1, int(request.form.get('full_days') or 7))))
+    set_setting('maint_full_ratio', str(max(1, min(100, int(request.form.get('full_ratio') or 20)))))
+    _maint_event.set()
+    flash("Mantenimiento guardado."); return redirect(url_for('home'))
 # ---------------------------------------------
 
 @app.route('/schedule/update', methods=['POST'])
-def schedule_update(): set_setting('freq', request.form.get('frequency')); set_setting('time', request.form.get('time')); return redirect(url_for('home'))
+def schedule_update():
+    freq = request.form.get('frequency'); cron = (request.form.get('cron') or '').strip()
+    if freq == 'cron':
+        # Ademas de leerse, tiene que disparar alguna vez (ej: '0 3 31 2 *' nunca lo hace)
+        try: next_cron_time(cron, datetime.now(LOCAL_TZ))
+        except ValueError as e: flash(str(e)); return redirect(url_for('home'))
+        set_setting('cron', cron)
+    set_setting('freq', freq)
+    if request.form.get('time'): set_setting('time', request.form.get('time'))
+    if request.form.get('parallel'): set_setting('backup_parallel', str(max(1, request.form.get('parallel', 2, type=int))))
+    set_setting('sched_last:global', str(time.time())); notify_scheduler()
+    return redirect(url_for('home'))
+@app.route('/source/schedule', methods=['POST'])
+def source_schedule():
+    p = request.form.get('path'); cron = (request.form.get('cron') or '').strip()
+    if cron:
+        # Ademas de leerse, tiene que disparar alguna vez (ej: '0 3 31 2 *' nunca lo hace)
+        try: next_cron_time(cron, datetime.now(LOCAL_TZ))
+        except ValueError as e: flash(str(e)); return redirect(url_for('home'))
+    set_source_schedule(p, cron); set_setting(f'sched_last:{p}', str(time.time())); reload_sources(); notify_scheduler()
+    return redirect(url_for('home'))
 @app.route('/api/docker/list', methods=['GET'])
-def api_docker_list(): s,o,_=run_command(['docker', 'ps', '--format', '{{.Names}}', '-a']); return jsonify({'containers': [l.strip() for l in o.splitlines() if l.strip()] if s else []})
+def api_docker_list(): return jsonify({'containers': docker_control.containers()})
 @app.route('/source/link_docker', methods=['POST'])
-def source_link_docker(): p=request.form.get('path'); c=request.form.get('container_name'); set_docker_link(p,c); return redirect(url_for('home'))
+def source_link_docker():
+    p=request.form.get('path'); c=','.join(n.strip() for n in request.form.getlist('container_name') if n.strip())
+    mode=request.form.get('quiesce', 'pause'); set_docker_link(p,c)
+    set_quiesce(p, mode if mode in QUIESCE_MODES else 'pause', (request.form.get('pre_hook') or '').strip(), (request.form.get('post_hook') or '').strip()) if c else set_quiesce(p, None)
+    reload_sources(); return redirect(url_for('home'))
 @app.route('/api/browse', methods=['POST'])
 def api_browse():
+    # Paginado por cursor (ultima entrada devuelta), filtro por prefijo y detalles opcionales (tamano, mtime)
     try:
-        cp = request.json.get('path', '/host'); cp = '/host' if not cp.startswith('/host') else cp
-        items = []; 
-        with os.scandir(cp) as it:
-            for e in it: items.append({'name': e.name, 'path': e.path, 'type': 'dir' if e.is_dir() else 'file'})
-        items.sort(key=lambda x: (x['type'] != 'dir', x['name'])); return jsonify({'current': cp, 'parent': os.path.dirname(cp) if len(os.path.dirname(cp))>=5 else '/host', 'items': items})
+        body = request.json or {}
+        cp = browse_path(body.get('path', HOST_ROOT)); entries, stats = list_directory(cp)
+        limit = min(max(int(body.get('limit') or BROWSE_PAGE_SIZE), 1), 1000)
+        prefix = (body.get('prefix') or '').lower(); details = bool(body.get('details'))
+        start = 0
+        if body.get('cursor'):
+            kind, _, name = body['cursor'].partition('/')
+            if kind not in ('0', '1'): return jsonify({'error': 'cursor invalido'}), 400
+            start = bisect.bisect_right(entries, (int(kind), name))
+        items = []; pos = start
+        # Subcarpetas medibles: en el mismo sistema de archivos que esta (no son puntos de montaje) y no virtual/de red
+        if details: cp_dev = os.stat(cp).st_dev; cp_sizable = mount_type(cp) not in NO_SIZE_FS
+        while pos < len(entries) and len(items) < limit:
+            kind, name = entries[pos]; pos += 1
+            if prefix and not name.lower().startswith(prefix): continue
+            item = {'name': name, 'path': os.path.join(cp, name), 'type': 'dir' if kind == 0 else 'file'}
+            if details:
+                st = stats.get(name)
+                if st is None: item['mtime'] = item['size'] = None
+                elif kind == 0:
+                    sizable = cp_sizable and st[2] == cp_dev; item['mtime'] = st[1]
+                    item['size'] = cached_dir_size(item['path'], sizable)
+                    # Punto de montaje o sistema virtual/de red: sin tamano, el navegador no lo espera
+                    if not sizable: item['sized'] = False
+                else: item['size'], item['mtime'] = st[0], st[1]
+            items.append(item)
+        more = pos < len(entries) and (not prefix or any(n.lower().startswith(prefix) for _, n in entries[pos:]))
+        next_cursor = f"{entries[pos - 1][0]}/{entries[pos - 1][1]}" if more else None
+        return jsonify({'current': cp, 'parent': os.path.dirname(cp) if cp != HOST_ROOT else HOST_ROOT, 'items': items, 'next_cursor': next_cursor, 'total': len(entries)})
     except Exception as e: return jsonify({'error': str(e)}), 500
+@app.route('/api/browse/sizes', methods=['POST'])
+def api_browse_sizes():
+    paths = [browse_path(p) for p in (request.json or {}).get('paths', [])[:BROWSE_PAGE_SIZE]]
+    return jsonify({'sizes': {p: cached_dir_size(p) for p in paths}})
 @app.route('/restore/history', methods=['GET'])
 def restore_history(): 
     p=request.args.get('path'); 
     if not p: return redirect(url_for('home'))
-    d=get_docker_link(p); s,o,_=run_kopia(['snapshot', 'list', p, '--json']); snaps=[]
-    if s:
-        try:
-            rs=json.loads(o)
-            for x in rs: 
-                sz=x.get('stats',{}).get('totalSize',0); szs=f"{sz} B"
-                if sz>1024: szs=f"{sz/1024:.1f} KB"
-                if sz>1048576: szs=f"{sz/1048576:.1f} MB"
-                raw_time = x.get('startTime', '')
-                try:
-                    dt_utc = datetime.fromisoformat(raw_time.replace('Z', '+00:00'))
-                    display_time = dt_utc.astimezone(LOCAL_TZ).strftime('%Y-%m-%d %I:%M %p')
-                except: display_time = raw_time
-                snaps.append({'id': x.get('id',''), 'short_id': x.get('id','')[:8], 'time': display_time, 'size': szs, 'files': x.get('stats',{}).get('fileCount',0)})
-            snaps.reverse()
-        except: pass
-    return render_template('history.html', snapshots=snaps, source_path=p, docker_link=d)
+    d=get_docker_link(p)
+    if not source_indexed(p): sync_snapshot_index([p])
+    snaps, next_cursor = query_snapshots(p, limit=HISTORY_PAGE_SIZE)
+    return render_template('history.html', snapshots=snaps, next_cursor=next_cursor, source_path=p, docker_link=d)
+@app.route('/api/snapshots', methods=['GET'])
+def api_snapshots():
+    p=request.args.get('path')
+    if not p: return jsonify({'error': 'path requerido'}), 400
+    limit=min(max(request.args.get('limit', HISTORY_PAGE_SIZE, type=int), 1), 500)
+    snaps, next_cursor = query_snapshots(p, request.args.get('cursor'), limit)
+    return jsonify({'snapshots': snaps, 'next_cursor': next_cursor})
 @app.route('/backup/restore', methods=['POST'])
 def backup_restore():
-    sid=request.form.get('snapshot_id'); p=request.form.get('path'); d=get_docker_link(p)
-    if d: run_command(['docker', 'stop', d])
-    s,_,e=run_kopia(['snapshot', 'restore', sid, p])
-    if d: run_command(['docker', 'start', d])
-    flash("Restaurado." if s else f"Error: {e}"); return redirect(url_for('restore_history', path=p))
+    sid=request.form.get('snapshot_id'); p=request.form.get('path')
+    try: rel=snapshot_relpath(request.form.get('rel'))
+    except ValueError as e: flash(str(e)); return redirect(url_for('restore_history', path=p))
+    # Restaurar todo detiene siempre los contenedores; una parte solo si se pide
+    stop = not rel or request.form.get('stop') == '1'
+    label = f'Restaurar {os.path.join(p, rel)}' if rel else f'Restaurar {p}'
+    return job_response(submit_job('restore', do_restore, sid, p, rel, stop, label=label, key=f'restore:{p}'), 'restore_history', path=p)
+@app.route('/api/snapshot/browse', methods=['GET'])
+def api_snapshot_browse():
+    # Un nivel del snapshot, paginado por cursor como /api/browse
+    sid=request.args.get('id')
+    try: rel=snapshot_relpath(request.args.get('path'))
+    except ValueError as e: return jsonify({'error': str(e)}), 400
+    entry = snapshot_entry(sid, rel)
+    if not entry or entry['type'] != 'dir': return jsonify({'error': 'Carpeta no encontrada en el snapshot'}), 404
+    entries = list_snapshot_dir(entry['obj'])
+    if entries is None: return jsonify({'error': 'No se pudo leer el snapshot'}), 500
+    limit = min(max(request.args.get('limit', BROWSE_PAGE_SIZE, type=int), 1), 1000); start = 0
+    if request.args.get('cursor'):
+        kind, _, name = request.args['cursor'].partition('/')
+        if kind not in ('0', '1'): return jsonify({'error': 'cursor invalido'}), 400
+        start = bisect.bisect_right([e[:2] for e in entries], (int(kind), name))
+    page = entries[start:start + limit]
+    items = [{'name': name, 'path': f'{rel}/{name}' if rel else name, 'type': info['type'], 'size': info['size'], 'files': info['files'], 'mtime': info['mtime']} for _, name, info in page]
+    next_cursor = f"{page[-1][0]}/{page[-1][1]}" if start + limit < len(entries) else None
+    return jsonify({'path': rel, 'parent': os.path.dirname(rel) if rel else None, 'items': items, 'next_cursor': next_cursor, 'total': len(entries)})
+@app.route('/snapshot/download', methods=['GET'])
+def snapshot_download():
+    # Un archivo tal cual o una carpeta como tar, generados por kopia al vuelo
+    sid=request.args.get('id')
+    try: rel=snapshot_relpath(request.args.get('path'))
+    except ValueError as e: return jsonify({'error': str(e)}), 400
+    source, root = snapshot_root(sid); entry = snapshot_entry(sid, rel)
+    if not entry or entry['type'] == 'link': return jsonify({'error': 'Ruta no encontrada en el snapshot'}), 404
+    obj = f'{root}/{rel}' if rel else root
+    name = os.path.basename(rel) or os.path.basename(source) or 'snapshot'; headers = {}
+    if entry['type'] == 'dir':
+        # kopia escribe el tar en el archivo destino: /dev/stdout es el pipe hacia aqui
+        chunks = stream_kopia(['snapshot', 'restore', obj, '/dev/stdout', '--mode=tar']); name += '.tar'; mimetype = 'application/x-tar'
+    else:
+        chunks = stream_kopia(['show', obj]); mimetype = 'application/octet-stream'
+        if entry['size'] is not None: headers['Content-Length'] = str(entry['size'])
+    if chunks is None: return jsonify({'error': 'kopia no pudo leer el snapshot'}), 500
+    headers['Content-Disposition'] = f"attachment; filename*=UTF-8''{urllib.parse.quote(name)}"
+    return Response(stream_with_context(chunks), mimetype=mimetype, headers=headers)
 @app.route('/snapshot/delete', methods=['POST'])
-def snapshot_delete(): sid=request.form.get('snapshot_id'); p=request.form.get('path'); run_kopia(['snapshot', 'delete', sid, '--delete']); return redirect(url_for('restore_history', path=p))
+def snapshot_delete(): sid=request.form.get('snapshot_id'); p=request.form.get('path'); run_kopia(['snapshot', 'delete', sid, '--delete']); remove_snapshot_index(sid); clear_source_manifest(p); request_repo_refresh(); return redirect(url_for('restore_history', path=p))
 @app.route('/source/add', methods=['POST'])
-def source_add(): run_kopia(['policy', 'set', request.form.get('path'), '--compression', 'zstd']); return redirect(url_for('home'))
+def source_add(): run_kopia(['policy', 'set', request.form.get('path'), '--compression', 'zstd']); clear_source_manifest(request.form.get('path')); reload_sources(); return redirect(url_for('home'))
 @app.route('/source/ignore', methods=['POST'])
-def source_ignore(): run_kopia(['policy', 'set', request.form.get('path'), '--add-ignore', os.path.relpath(request.form.get('target'), request.form.get('path'))]); return redirect(url_for('home'))
+def source_ignore(): run_kopia(['policy', 'set', request.form.get('path'), '--add-ignore', os.path.relpath(request.form.get('target'), request.form.get('path'))]); clear_source_manifest(request.form.get('path')); reload_sources(); return redirect(url_for('home'))
 @app.route('/source/delete', methods=['POST'])
-def source_delete(): run_kopia(['policy', 'delete', request.form.get('path')]); set_docker_link(request.form.get('path'), None); return redirect(url_for('home'))
+def source_delete(): run_kopia(['policy', 'delete', request.form.get('path')]); set_docker_link(request.form.get('path'), None); set_quiesce(request.form.get('path'), None); clear_source_manifest(request.form.get('path')); set_source_schedule(request.form.get('path'), None); reload_sources(); notify_scheduler(); return redirect(url_for('home'))
 
 @app.route('/backup/run', methods=['POST'])
-def backup_run():
-    s = get_policies(); p = [x['path'] for x in s]
-    success, _, err = run_kopia(['snapshot', 'create'] + p)
-    if success:
-        flash_msg = "Backup Local Exitoso."
-        
-        # Mantenimiento completo para borrar snapshots viejos
-        run_kopia(['maintenance', 'run', '--full'])
-        
-        cloud_cfg = get_cloud_config()
-        if cloud_cfg:
-            print("--- Auto Sync tras Backup Manual ---", flush=True)
-            cmd_sync = ['repository', 'sync-to', 's3', '--delete', '--bucket', cloud_cfg['bucket'], '--access-key', cloud_cfg['access_key'], '--secret-access-key', cloud_cfg['secret_key']]
-            if cloud_cfg['endpoint']: cmd_sync.extend(['--endpoint', cloud_cfg['endpoint']])
-            if cloud_cfg['region']: cmd_sync.extend(['--region', cloud_cfg['region']])
-            s_sync, _, err_sync = run_kopia(cmd_sync)
-            if s_sync:
-                flash_msg += " Y Sincronizacion a Nube Completada."
-                send_notification("Backup Manual + Sync Nube Exitoso")
-            else:
-                flash_msg += f" Pero fallo la Nube: {err_sync}"
-                print(f"Error Sync Manual: {err_sync}", flush=True)
-                send_notification(f"Sync Nube fallo: {err_sync}", False)
-        else: send_notification("Backup Manual Local Exitoso")
-        flash(flash_msg)
-    else:
-        flash(f"Error: {err}"); send_notification(f"Fallo Backup: {err}", False)
-    return redirect(url_for('home'))
+def backup_run(): return job_response(submit_job('backup', do_backup, label='Backup Local'), 'home')
+
+@app.route('/metrics')
+def metrics(): return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/metrics/summary')
+def api_metrics_summary(): return jsonify(metrics_summary())
+
+@app.route('/api/jobs', methods=['GET'])
+def api_jobs():
+    with db() as conn: rows = [dict(r, progress={}) for r in conn.execute('SELECT * FROM jobs ORDER BY created DESC LIMIT ?', (min(request.args.get('limit', 20, type=int), 200),))]
+    live = {j.id: j.to_dict() for j in active_jobs()}
+    return jsonify({'jobs': [live.get(r['id'], r) for r in rows]})
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def api_job(job_id):
+    job = get_job(job_id); d = job.to_dict() if job else load_job(job_id)
+    return jsonify(d) if d else (jsonify({'error': 'Trabajo no encontrado'}), 404)
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def api_job_cancel(job_id):
+    job = get_job(job_id)
+    if not job or job.done: return jsonify({'error': 'El trabajo no esta activo'}), 409
+    job.cancel(); return jsonify(job.to_dict())
+@app.route('/api/jobs/<job_id>/events', methods=['GET'])
+def api_job_events(job_id):
+    # Server-Sent Events: una linea de progreso de kopia por evento y un evento 'done' al terminar
+    job = get_job(job_id)
+    if not job:
+        d = load_job(job_id)
+        if not d: return jsonify({'error': 'Trabajo no encontrado'}), 404
+        return Response(f"event: done\ndata: {json.dumps(d)}\n\n", mimetype='text/event-stream')
+    start = request.headers.get('Last-Event-ID', 0, type=int)
+    def stream():
+        seq = start
+        while True:
+            with job.cond:
+                if job.seq == seq and not job.done: job.cond.wait(15)
+                new = [(n, line) for n, line in job.lines if n > seq]; done = job.done
+            snap = job.to_dict()
+            for n, line in new: yield f"id: {n}\ndata: {json.dumps({'line': line, 'progress': snap['progress']})}\n\n"
+            if new: seq = new[-1][0]
+            if done: yield f"event: done\ndata: {json.dumps(snap)}\n\n"; return
+            if not new: yield ": ping\n\n"
+    return Response(stream_with_context(stream()), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.context_processor
+def inject_jobs():
+    # Trabajos a mostrar en el panel de progreso: los activos y el recien lanzado (?job=) aunque ya haya terminado
+    jobs = {j.id: j.to_dict() for j in active_jobs()}
+    jid = request.args.get('job')
+    if jid and jid not in jobs:
+        job = get_job(jid); d = job.to_dict() if job else load_job(jid)
+        if d: jobs[jid] = d
+    return {'jobs': list(jobs.values())}
 
 @app.route('/setup', methods=['GET', 'POST'])
 def setup():
@@ -369,8 +2057,10 @@ def logout(): session.pop('user',None); return redirect(url_for('login'))
 
 @app.route('/repo/setup')
 def repo_setup():
-    if os.path.exists(KOPIA_CONFIG): return redirect(url_for('home'))
-    return render_template('repo.html')
+    if os.path.exists(KOPIA_CONFIG) and not rescue_in_progress() and not rescue_pending() and not request.args.get('job'): return redirect(url_for('home'))
+    rows = rescue_checkpoint()
+    cfg = get_settings({'rescue_parallel': '2', 'rescue_priority': ''})
+    return render_template('repo.html', rescue=rows, rescue_done=sum(1 for r in rows if r['status'] == 'done'), rescue_cfg=cfg)
 
 @app.route('/repo/create', methods=['POST'])
 def repo_create():
@@ -382,77 +2072,25 @@ def repo_create():
     if not s: s,_,e = run_kopia(['repository', 'connect']+cmd, env)
     if s: 
         run_kopia(['policy', 'set', '--global', '--keep-latest', '5'], env)
+        # Repositorio nuevo o distinto: el punto de control de un rescate anterior ya no aplica
+        clear_rescue_checkpoint(); kopia_backend.reset(); clear_snapshot_index(); refresh_repo_state()
         return redirect(url_for('home'))
     print(f"Repo Error: {e}", flush=True); flash(f"Error: {e}"); return redirect(url_for('repo_setup'))
 
 # --- RESCATE v2.8 (IN-PLACE RESTORE) ---
 @app.route('/repo/rescue', methods=['POST'])
 def repo_rescue():
-    # Nota: local_path en el form se ignora para la restauracion de archivos, 
-    # pero lo usamos para saber donde poner el Repo Local (Database).
-    repo_location = request.form.get('local_path'); 
-    pwd = request.form.get('repo_password')
-    bucket = request.form.get('bucket'); access = request.form.get('access_key'); secret = request.form.get('secret_key')
-    endpoint = request.form.get('endpoint'); region = request.form.get('region'); env = {'KOPIA_PASSWORD': pwd}
-    
-    print("--- INICIANDO RESCATE v2.8 (IN-PLACE) ---", flush=True)
+    return job_response(submit_job('rescue', do_rescue, request.form.to_dict(), label='Rescate'), 'repo_setup')
 
-    # 1. Conectar a Nube
-    s, _, e = run_kopia(['repository', 'connect', 's3', '--bucket', bucket, '--access-key', access, '--secret-access-key', secret, '--endpoint', endpoint, '--region', region], env)
-    if not s: flash(f"Error Nube: {e}"); return redirect(url_for('repo_setup'))
+@app.route('/repo/rescue/discard', methods=['POST'])
+def repo_rescue_discard():
+    if rescue_in_progress(): flash("Hay un rescate en curso: cancelalo antes de descartarlo."); return redirect(url_for('repo_setup'))
+    clear_rescue_checkpoint(); flash("Punto de control del rescate descartado.")
+    return redirect(url_for('home' if os.path.exists(KOPIA_CONFIG) else 'repo_setup'))
 
-    # 2. Obtener Snapshots
-    s, out, _ = run_kopia(['snapshot', 'list', '--json', '--all'], env)
-    
-    restored_count = 0
-    if s:
-        try:
-            snaps = json.loads(out)
-            snaps.sort(key=lambda x: x.get('startTime', ''), reverse=True)
-            
-            # Agrupar por origen unico (Rutas Originales)
-            unique_sources = {}
-            for snap in snaps:
-                src_path = snap.get('source', {}).get('path', '')
-                if src_path and src_path not in unique_sources:
-                    unique_sources[src_path] = snap['id']
-            
-            # 3. RESTAURACION EN SITIO (In-Place)
-            for src_path, snap_id in unique_sources.items():
-                print(f"Restaurando IN-PLACE: {src_path} (Snap: {snap_id})", flush=True)
-                
-                # Restauramos DIRECTAMENTE a la ruta original (src_path)
-                s_res, _, err_res = run_kopia(['snapshot', 'restore', snap_id, src_path], env)
-                
-                if s_res:
-                    restored_count += 1
-                else:
-                    print(f"Error restaurando {src_path}: {err_res}", flush=True)
-
-        except Exception as ex:
-            print(f"Error procesando snapshots: {ex}", flush=True)
-
-    if restored_count > 0:
-        # 4. Reconfiguracion Local (Database)
-        if os.path.exists(KOPIA_CONFIG): os.remove(KOPIA_CONFIG)
-        
-        # Usamos la ruta que puso el usuario SOLO para guardar la DB de Kopia, no los archivos.
-        # Si el usuario puso /host/backups, ahi vivira la DB.
-        repo_storage = repo_location
-        if os.path.exists(repo_storage): shutil.rmtree(repo_storage, ignore_errors=True)
-        if not os.path.exists(repo_storage): os.makedirs(repo_storage, exist_ok=True)
-        
-        s, _, e = run_kopia(['repository', 'create', 'filesystem', '--path', repo_storage], env)
-        
-        if s:
-            set_cloud_config('s3', bucket, access, secret, endpoint, region)
-            flash(f"Rescate Exitoso! Se restauraron {restored_count} rutas en su ubicacion original.")
-            return redirect(url_for('home'))
-        else:
-            flash(f"Datos restaurados, pero fallo config local: {e}")
-            return redirect(url_for('repo_setup'))
-    else:
-        flash("No se encontraron snapshots validos.")
-        return redirect(url_for('repo_setup'))
+@app.route('/api/rescue')
+def api_rescue():
+    job = next((j for j in active_jobs() if j.kind == 'rescue'), None)
+    return jsonify({'active': job is not None, 'sources': rescue_status(job)})
 
 if __name__ == '__main__': app.run(host='0.0.0.0', port=51515)
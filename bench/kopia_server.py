@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+"""Stand-in de 'kopia server' para bench/run.py con el backend de servidor de ShieldPi.
+
+Sirve con HTTP/1.1 keep-alive y autenticacion basica la parte de la API /api/v1 que usa KopiaServer sobre el
+repositorio sintetico de bench/standin.py. Cada peticion espera BENCH_LATENCY segundos y se anota en BENCH_CALL_LOG.
+
+    SHIELDPI_KOPIA_SERVER_PASSWORD=x python bench/kopia_server.py --address 127.0.0.1:51516
+"""
+import argparse
+import base64
+import itertools
+import json
+import os
+import socket
+import sys
+import threading
+import time
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from standin import HOST, M, SOURCES, USER, directory, policies, resolve, snapshot  # noqa: E402
+
+USERNAME = os.environ.get('SHIELDPI_KOPIA_SERVER_USER', 'shieldpi')
+PASSWORD = os.environ.get('SHIELDPI_KOPIA_SERVER_PASSWORD', '')
+_tasks = {}
+_task_ids = itertools.count(1)
+_tasks_lock = threading.Lock()
+
+
+def list_snapshots(query):
+    path = query.get('path', [''])[0]
+    if path not in SOURCES: return {'snapshots': [], 'unfilteredCount': 0, 'uniqueCount': 0}
+    snaps = []
+    for j in range(M):
+        s = snapshot(path, j)
+        snaps.append({'id': s['id'], 'startTime': s['startTime'], 'endTime': s['endTime'], 'rootID': s['root'], 'pins': [],
+                      'summary': {'size': s['size'], 'files': s['files'], 'symlinks': 0, 'dirs': 0, 'maxTime': s['endTime']}})
+    return {'snapshots': snaps, 'unfilteredCount': M, 'uniqueCount': M}
+
+
+def start_restore(body):
+    # La tarea termina al momento: la primera consulta ya la ve completada, como una restauracion pequena
+    found = resolve(body.get('root', ''))
+    with _tasks_lock:
+        tid = str(next(_task_ids))
+        _tasks[tid] = {'id': tid, 'kind': 'Restore', 'status': 'SUCCESS' if found else 'FAILED', 'errorMessage': '' if found else 'object not found',
+                       'counters': {'Restored Files': {'value': 0 if not found or found[1] else 1, 'units': ''},
+                                    'Restored Bytes': {'value': 0, 'units': 'bytes'}, 'Skipped Files': {'value': 0, 'units': ''}}}
+    return _tasks[tid]
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, fmt, *args): pass
+
+    def setup(self):
+        # Como el servidor de Go: sin Nagle, si no cabecera y cuerpo por separado esperan el ACK retardado del cliente
+        super().setup(); self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def reply(self, status, payload=None):
+        data = json.dumps(payload if payload is not None else {}).encode()
+        self.send_response(status); self.send_header('Content-Type', 'application/json'); self.send_header('Content-Length', str(len(data)))
+        self.end_headers(); self.wfile.write(data)
+
+    def authorized(self):
+        expected = 'Basic ' + base64.b64encode(f'{USERNAME}:{PASSWORD}'.encode()).decode()
+        return self.headers.get('Authorization') == expected
+
+    def handle_api(self, method):
+        url = urllib.parse.urlsplit(self.path); path = url.path; query = urllib.parse.parse_qs(url.query)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length)) if length else {}
+        if os.environ.get('BENCH_CALL_LOG'):
+            with open(os.environ['BENCH_CALL_LOG'], 'a') as f: f.write(f'api {method} {path}'[:120] + '\n')
+        time.sleep(float(os.environ.get('BENCH_LATENCY', '0')))
+        if not self.authorized(): return self.reply(401, {'error': 'access denied'})
+        if method == 'GET' and path == '/api/v1/repo/status': return self.reply(200, {'connected': True, 'hash': 'BLAKE2B-256-128', 'encryption': 'AES256-GCM-HMAC-SHA256'})
+        if method == 'GET' and path == '/api/v1/policies': return self.reply(200, {'policies': policies()})
+        if method == 'GET' and path == '/api/v1/sources':
+            return self.reply(200, {'localHost': HOST, 'localUsername': USER, 'multiUser': False,
+                                    'sources': [{'source': {'host': HOST, 'userName': USER, 'path': p}, 'status': 'IDLE'} for p in SOURCES]})
+        if method == 'GET' and path == '/api/v1/snapshots': return self.reply(200, list_snapshots(query))
+        if method == 'GET' and path.startswith('/api/v1/objects/'):
+            manifest = directory(path.rsplit('/', 1)[1])
+            return self.reply(200, manifest) if manifest else self.reply(404, {'error': 'object not found'})
+        if method == 'POST' and path == '/api/v1/restore': return self.reply(200, start_restore(body))
+        if path.startswith('/api/v1/tasks/'):
+            tid = path.split('/')[4]
+            with _tasks_lock: task = _tasks.get(tid)
+            if task is None: return self.reply(404, {'error': 'task not found'})
+            return self.reply(200, task if method == 'GET' else {})
+        if method == 'POST' and path == '/api/v1/refresh': return self.reply(200, {})
+        self.reply(404, {'error': f'{method} {path} no soportado'})
+
+    def do_GET(self): self.handle_api('GET')
+    def do_POST(self): self.handle_api('POST')
+
+
+def serve(address):
+    host, port = address.rsplit(':', 1)
+    server = ThreadingHTTPServer((host, int(port)), Handler); server.daemon_threads = True
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Stand-in de kopia server para el benchmark')
+    parser.add_argument('--address', default='127.0.0.1:51516')
+    serve(parser.parse_args().address).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
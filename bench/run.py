@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+"""Benchmark de ShieldPi sin repositorio real.
+
+Pone los stand-in de bench/bin (kopia y docker) delante en el PATH, genera un arbol /host sintetico en un
+directorio temporal y mide con el cliente de pruebas de Flask la latencia (fria y en caliente), las llamadas a
+kopia/docker y la memoria de cada ruta o funcion.
+
+    python bench/run.py --sources 50 --snapshots 200 --latency 0.02
+    python bench/run.py --sources 10,100 --snapshots 500 --output bench_output.txt
+    python bench/run.py --backend server     # KopiaServer contra el stand-in bench/kopia_server.py
+"""
+import argparse
+import os
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+def make_host_tree(root, sources, dirs, files, file_size):
+    # src000..srcNNN, cada uno con 'dirs' subcarpetas de 'files' archivos; una carpeta ancha para el paginado de /api/browse
+    payload = b'x' * file_size
+    for i in range(sources):
+        for d in range(dirs):
+            path = os.path.join(root, f'src{i:03d}', f'dir{d:03d}')
+            os.makedirs(path, exist_ok=True)
+            for f in range(files):
+                with open(os.path.join(path, f'file{f:04d}.dat'), 'wb') as fh: fh.write(payload)
+    wide = os.path.join(root, 'wide')
+    os.makedirs(wide, exist_ok=True)
+    for f in range(dirs * files):
+        open(os.path.join(wide, f'entry{f:05d}.dat'), 'wb').close()
+    os.makedirs(os.path.join(root, 'backups'), exist_ok=True)
+
+
+def setup_env(work, args, sources):
+    os.environ['PATH'] = os.path.join(BENCH_DIR, 'bin') + os.pathsep + os.environ['PATH']
+    os.environ.update({
+        'SHIELDPI_CONFIG_DIR': os.path.join(work, 'config'), 'SHIELDPI_HOST_ROOT': os.path.join(work, 'host'),
+        'BENCH_SOURCES': str(sources), 'BENCH_SNAPSHOTS': str(args.snapshots), 'BENCH_LATENCY': str(args.latency),
+        'BENCH_CONTAINERS': str(args.containers), 'BENCH_CALL_LOG': os.path.join(work, 'calls.log'),
+        'BENCH_TREE_DIRS': str(args.dirs), 'BENCH_TREE_FILES': str(args.files),
+    })
+    os.makedirs(os.environ['SHIELDPI_CONFIG_DIR'], exist_ok=True)
+    open(os.path.join(os.environ['SHIELDPI_CONFIG_DIR'], 'repository.config'), 'w').write('{}')
+    if args.backend != 'server': return None
+    # Backend de servidor: el stand-in corre aparte y la app se conecta a el como servidor externo
+    with socket.socket() as s: s.bind(('127.0.0.1', 0)); address = f'127.0.0.1:{s.getsockname()[1]}'
+    os.environ.update({'SHIELDPI_KOPIA_BACKEND': 'server', 'SHIELDPI_KOPIA_SERVER_EXTERNAL': '1', 'SHIELDPI_KOPIA_SERVER_ADDRESS': address,
+                       'SHIELDPI_KOPIA_SERVER_PASSWORD': 'bench'})
+    server = subprocess.Popen([sys.executable, os.path.join(BENCH_DIR, 'kopia_server.py'), '--address', address])
+    for _ in range(100):
+        try: socket.create_connection(address.rsplit(':', 1), timeout=0.2).close(); return server
+        except OSError: time.sleep(0.1)
+    server.kill(); raise RuntimeError('el stand-in de kopia server no arranco')
+
+
+def calls_since(mark):
+    with open(os.environ['BENCH_CALL_LOG']) as f: return len(f.readlines()) - mark
+
+
+def call_mark():
+    try:
+        with open(os.environ['BENCH_CALL_LOG']) as f: return len(f.readlines())
+    except FileNotFoundError: return 0
+
+
+def measure(name, fn, repeat, cold=None):
+    # cold() deja las caches vacias antes de la primera llamada; el resto mide el camino en caliente
+    if cold: cold()
+    mark = call_mark(); t = time.perf_counter(); fn(); cold_ms = (time.perf_counter() - t) * 1000
+    cold_calls = calls_since(mark)
+    times = []; mark = call_mark()
+    for _ in range(repeat):
+        t = time.perf_counter(); fn(); times.append((time.perf_counter() - t) * 1000)
+    warm_calls = calls_since(mark) / repeat
+    tracemalloc.start(); tracemalloc.reset_peak(); fn()
+    peak = tracemalloc.get_traced_memory()[1]; tracemalloc.stop()
+    times.sort()
+    return {'name': name, 'cold_ms': cold_ms, 'cold_calls': cold_calls, 'median_ms': statistics.median(times),
+            'p95_ms': times[min(len(times) - 1, int(len(times) * 0.95))], 'warm_calls': warm_calls, 'peak_kib': peak / 1024}
+
+
+def run_scenario(args, sources):
+    work = tempfile.mkdtemp(prefix='shieldpi-bench-'); server = None
+    try:
+        server = setup_env(work, args, sources)
+        make_host_tree(os.environ['SHIELDPI_HOST_ROOT'], sources, args.dirs, args.files, args.file_size)
+        # app lee SHIELDPI_CONFIG_DIR/HOST_ROOT al importarse: un escenario por proceso
+        sys.path.insert(0, os.path.join(REPO_DIR, 'app'))
+        import app as A
+        A.app.config['TESTING'] = True
+        A.create_user('bench', 'bench')
+        client = A.app.test_client()
+        with client.session_transaction() as s: s['user'] = 'bench'
+
+        host = A.HOST_ROOT; first = f'{host}/src000'
+        for i in range(sources):
+            if args.schedules: A.set_source_schedule(f'{host}/src{i:03d}', f'{i % 60} 3 * * *')
+        A.refresh_repo_state()
+        snaps, cursor = A.query_snapshots(first, limit=A.HISTORY_PAGE_SIZE); sid = snaps[0]['id']
+        restore_to = os.path.join(work, 'restore')
+
+        def get(url):
+            def fn():
+                r = client.get(url); assert r.status_code == 200, (url, r.status_code)
+            return fn
+
+        def post(url, body):
+            def fn():
+                r = client.post(url, json=body); assert r.status_code == 200, (url, r.status_code)
+            return fn
+
+        def clear_listing():
+            with A._listing_lock: A._listing_cache.clear()
+
+        def clear_state():
+            # Como tras un arranque: sin estado del repositorio ni catalogo de politicas en memoria
+            A.invalidate_policies()
+            with A._repo_state_lock: A._repo_state['updated'] = 0
+
+        def clear_snapshot_listing():
+            with A._snap_listing_lock: A._snap_listing_cache.clear()
+
+        def clear_maintenance_stats():
+            # Ultimo completo reciente: la decision depende de lo que mida 'snapshot gc'
+            A.set_setting('maint_last_full', str(time.time())); A.set_setting('maint_stats', '')
+
+        def clear_history():
+            with A.db() as conn: conn.execute('DELETE FROM snapshots WHERE source = ?', (first,))
+
+        cases = [
+            ('GET /', get('/'), clear_state),
+            ('refresh_repo_state()', A.refresh_repo_state, A.clear_snapshot_index),
+            ('get_policies()', A.get_policies, A.invalidate_policies),
+            ('GET /restore/history', get(f'/restore/history?path={first}'), clear_history),
+            ('GET /api/snapshots (pag. 2)', get(f'/api/snapshots?path={first}&cursor={cursor or ""}'), None),
+            ('POST /api/browse', post('/api/browse', {'path': first}), clear_listing),
+            ('POST /api/browse (ancho)', post('/api/browse', {'path': f'{host}/wide', 'details': True}), clear_listing),
+            ('POST /api/browse (prefijo)', post('/api/browse', {'path': f'{host}/wide', 'prefix': 'entry001'}), None),
+            ('GET /api/snapshot/browse', get(f'/api/snapshot/browse?id={sid}&path=dir000'), clear_snapshot_listing),
+            ('kopia_backend.restore()', lambda: A.kopia_backend.restore(f'{A.snapshot_root(sid)[1]}/dir000', restore_to), None),
+            ('GET /api/docker/list', get('/api/docker/list'), None),
+            ('scheduler heap', A._build_schedule_heap, None),
+            ('plan_maintenance()', A.plan_maintenance, clear_maintenance_stats),
+            ('GET /metrics', get('/metrics'), None),
+        ]
+        results = [measure(name, fn, args.repeat, cold) for name, fn, cold in cases]
+        return results
+    finally:
+        if server: server.kill(); server.wait()
+        shutil.rmtree(work, ignore_errors=True)
+
+
+def format_report(args, sources, results):
+    lines = [f"ShieldPi bench: backend {args.backend}, {sources} origenes, {args.snapshots} snapshots/origen, latencia kopia {args.latency * 1000:.0f} ms, "
+             f"arbol {args.dirs}x{args.files} archivos, {args.repeat} repeticiones",
+             f"{'caso':<30} {'frio ms':>9} {'llam.':>6} {'mediana':>9} {'p95 ms':>9} {'llam.':>6} {'pico KiB':>10}"]
+    for r in results:
+        lines.append(f"{r['name']:<30} {r['cold_ms']:>9.1f} {r['cold_calls']:>6} {r['median_ms']:>9.2f} {r['p95_ms']:>9.2f} {r['warm_calls']:>6.1f} {r['peak_kib']:>10.1f}")
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark de rutas de ShieldPi con kopia/docker simulados')
+    parser.add_argument('--sources', default='10', help='origenes; varios separados por comas para ver la escala (ej: 10,100)')
+    parser.add_argument('--snapshots', type=int, default=100, help='snapshots por origen')
+    parser.add_argument('--latency', type=float, default=0.0, help='segundos de espera por llamada a kopia/docker')
+    parser.add_argument('--containers', type=int, default=20)
+    parser.add_argument('--dirs', type=int, default=5, help='subcarpetas por origen')
+    parser.add_argument('--files', type=int, default=50, help='archivos por subcarpeta')
+    parser.add_argument('--file-size', type=int, default=1024)
+    parser.add_argument('--repeat', type=int, default=20)
+    parser.add_argument('--backend', choices=('cli', 'server'), default='cli', help='server: KopiaServer contra bench/kopia_server.py')
+    parser.add_argument('--no-schedules', dest='schedules', action='store_false', help='sin horario cron por origen')
+    parser.add_argument('--output', help='ademas del terminal, escribe el informe aqui (ej: bench_output.txt)')
+    args = parser.parse_args()
+
+    counts = [int(x) for x in args.sources.split(',')]
+    if len(counts) == 1: reports = [format_report(args, counts[0], run_scenario(args, counts[0]))]
+    else:
+        # Varios tamanos: cada uno en su propio proceso (la app guarda estado global al importarse)
+        argv = ['--snapshots', str(args.snapshots), '--latency', str(args.latency), '--containers', str(args.containers), '--dirs', str(args.dirs),
+                '--files', str(args.files), '--file-size', str(args.file_size), '--repeat', str(args.repeat), '--backend', args.backend] + ([] if args.schedules else ['--no-schedules'])
+        outs = [subprocess.run([sys.executable, __file__, '--sources', str(n)] + argv, check=True, capture_output=True, text=True).stdout for n in counts]
+        reports = [out[out.index('ShieldPi bench:'):].strip() for out in outs]
+    for report in reports: print(report + '\n', flush=True)
+    if args.output:
+        with open(args.output, 'w') as f: f.write('\n\n'.join(reports) + '\n')
+
+
+if __name__ == '__main__':
+    main()
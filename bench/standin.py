@@ -0,0 +1,66 @@
+"""Repositorio sintetico comun a los stand-in de kopia: el CLI (bench/bin/kopia) y el servidor (bench/kopia_server.py).
+
+BENCH_SOURCES origenes bajo SHIELDPI_HOST_ROOT con BENCH_SNAPSHOTS snapshots cada uno. Cada snapshot tiene un arbol de
+BENCH_TREE_DIRS carpetas con BENCH_TREE_FILES archivos; los IDs de objeto codifican su posicion, asi que no hay estado.
+"""
+import hashlib
+import os
+from datetime import datetime, timedelta, timezone
+
+N = int(os.environ.get('BENCH_SOURCES', '10')); M = int(os.environ.get('BENCH_SNAPSHOTS', '50'))
+DIRS = int(os.environ.get('BENCH_TREE_DIRS', '5')); FILES = int(os.environ.get('BENCH_TREE_FILES', '50'))
+ROOT = os.environ.get('SHIELDPI_HOST_ROOT', '/host')
+SOURCES = [f'{ROOT}/src{i:03d}' for i in range(N)]
+BASE = datetime(2026, 1, 1, tzinfo=timezone.utc)
+HOST, USER = 'bench', 'root'
+FILE_SIZE = 1024
+MTIME = '2026-01-01T00:00:00Z'
+
+
+def snapshot_id(path, j): return hashlib.sha1(f'{path}:{j}'.encode()).hexdigest()[:32]
+
+
+def snapshot(path, j):
+    start = BASE + timedelta(hours=j)
+    return {'id': snapshot_id(path, j), 'startTime': start.strftime('%Y-%m-%dT%H:%M:%S.000000Z'),
+            'endTime': (start + timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%S.000000Z'),
+            'root': f'kr{snapshot_id(path, j)}', 'size': 1048576 * (j + 1), 'files': 100 + j}
+
+
+def snapshots(paths):
+    # Forma de 'kopia snapshot list --json'
+    out = []
+    for p in paths:
+        for j in range(M):
+            s = snapshot(p, j)
+            out.append({'id': s['id'], 'source': {'host': HOST, 'userName': USER, 'path': p}, 'startTime': s['startTime'], 'endTime': s['endTime'],
+                        'rootEntry': {'obj': s['root'], 'type': 'd'}, 'stats': {'totalSize': s['size'], 'fileCount': s['files'], 'dirCount': DIRS}})
+    return out
+
+
+def policies():
+    return [{'id': 'global', 'target': {}, 'policy': {}}] + [
+        {'id': str(i), 'target': {'host': HOST, 'userName': USER, 'path': p}, 'policy': {'files': {'ignore': [f'cache{i}', '*.tmp']}}} for i, p in enumerate(SOURCES)]
+
+
+def directory(oid):
+    # Manifiesto de carpeta como lo devuelven 'kopia show' y /api/v1/objects: kr<sid> es la raiz, kd<NNN><sid> una carpeta
+    if oid.startswith('kr'):
+        sid = oid[2:]
+        entries = [{'name': f'dir{d:03d}', 'type': 'd', 'mode': '0755', 'mtime': MTIME, 'obj': f'kd{d:03d}{sid}',
+                    'summ': {'size': FILES * FILE_SIZE, 'files': FILES, 'dirs': 0}} for d in range(DIRS)]
+    elif oid.startswith('kd'):
+        entries = [{'name': f'file{f:04d}.dat', 'type': 'f', 'mode': '0644', 'mtime': MTIME, 'size': FILE_SIZE, 'obj': f'kf{oid[2:]}'} for f in range(FILES)]
+    else: return None
+    return {'stream': 'kopia:directory', 'entries': entries}
+
+
+def resolve(path):
+    # '<oid>/dir/archivo' -> (oid, es_carpeta); None si algun tramo no existe
+    oid, *names = path.split('/')
+    is_dir = directory(oid) is not None
+    for name in filter(None, names):
+        entry = next((e for e in (directory(oid) or {}).get('entries', []) if e['name'] == name), None)
+        if entry is None: return None
+        oid, is_dir = entry['obj'], entry['type'] == 'd'
+    return oid, is_dir